@@ -32,7 +32,11 @@
 
  *     IMServer.php?action=get&key=KEYTOSET
 
- *     returns the stored message
+ *     returns the stored message, with an ETag header of the quoted MD5 hash of the
+
+ *     message - if the If-None-Match request header matches it, returns 304 Not
+
+ *     Modified instead
 
  *
 
@@ -44,6 +48,48 @@
 
  *
 
+ *  BATCH:
+
+ *     IMServer.php?action=batch&clear=1&unset[]=KEY&setkey[]=KEY&setvalue[]=VALUE&get[]=KEY
+
+ *     applies the clear, then every unset, then every set, then every get (each
+
+ *     part is optional and may be repeated), and returns a JSON object mapping
+
+ *     each requested get key to its stored value
+
+ *
+
+ *  WATCH:
+
+ *     IMServer.php?action=watch&key=KEYTOWATCH&value=LASTVALUE&timeout=SECONDS
+
+ *     waits until the stored message differs from LASTVALUE, or the timeout
+
+ *     (at most 30 seconds) expires, and returns the stored message
+
+ *
+
+ *  CAS:
+
+ *     IMServer.php?action=cas&key=KEYTOSET&expected=EXPECTEDVALUE&value=VALUETOSET
+
+ *     sets the value only if the stored message is EXPECTEDVALUE, and returns 1 if
+
+ *     it was set or 0 otherwise
+
+ *
+
+ *  INCR:
+
+ *     IMServer.php?action=incr&key=KEYTOSET&by=AMOUNT
+
+ *     adds AMOUNT (1 by default) to the stored number, treating a missing value
+
+ *     as 0, and returns the result
+
+ *
+
  */
 
 
@@ -111,6 +157,20 @@ define("DATA_FILE",
 
     "/tmp/im.".$username.".data");
 
+// Hold an exclusive lock from reading the data file until writing it back, so that
+
+// concurrent requests can't lose each other's updates and 'cas' and 'incr' are atomic
+
+$lock = fopen(DATA_FILE.".lock", "c");
+
+if ($lock)
+
+{
+
+	flock($lock, LOCK_EX);
+
+}
+
 $_APP = array();
 
 if (file_exists(DATA_FILE))
@@ -151,11 +211,29 @@ switch ($action)
 
   case 'get':
 
-    // Return the dictionary value
+    // Return the dictionary value, tagged with a hash of it so that clients can cache it, or just
 
-    print $_APP[$key];
+    // 304 Not Modified if it still matches the client's cached copy. Reading changes nothing, so
 
-    break;
+    // exits without writing the data file back
+
+    $current = isset($_APP[$key]) ? (string)$_APP[$key] : '';
+
+    $etag = '"'.md5($current).'"';
+
+    header('ETag: '.$etag);
+
+    if (isset($_SERVER['HTTP_IF_NONE_MATCH']) && ($_SERVER['HTTP_IF_NONE_MATCH'] === $etag)) {
+
+        http_response_code(304);
+
+    } else {
+
+        print $current;
+
+    }
+
+    exit;
 
 
 
@@ -205,6 +283,146 @@ switch ($action)
 
 
 
+  case 'batch':
+
+    // Apply several operations in one request: clear, then unset, then set, then get
+
+    if (isset($_GET['clear'])) {
+
+        $_APP = array();
+
+    }
+
+    if (isset($_GET['unset'])) {
+
+        foreach ((array)$_GET['unset'] as $k) {
+
+            unset($_APP[$k]);
+
+        }
+
+    }
+
+    if (isset($_GET['setkey'])) {
+
+        $setValues = isset($_GET['setvalue']) ? (array)$_GET['setvalue'] : array();
+
+        foreach ((array)$_GET['setkey'] as $i => $k) {
+
+            $_APP[$k] = isset($setValues[$i]) ? $setValues[$i] : '';
+
+        }
+
+    }
+
+    $result = array();
+
+    if (isset($_GET['get'])) {
+
+        foreach ((array)$_GET['get'] as $k) {
+
+            $result[$k] = isset($_APP[$k]) ? $_APP[$k] : '';
+
+        }
+
+    }
+
+    header('Content-Type: application/json');
+
+    print json_encode((object)$result);
+
+    break;
+
+
+
+  case 'watch':
+
+    // Wait for the dictionary value to change, re-reading the data file whenever its contents change.
+
+    // Releases the lock while waiting, and exits without writing the data file back, so that changes
+
+    // made meanwhile aren't overwritten
+
+    $timeout = isset($_GET['timeout']) ? min(max((float)$_GET['timeout'], 0), 30) : 10;
+
+    if ($lock) {
+
+        flock($lock, LOCK_UN);
+
+    }
+
+    set_time_limit($timeout + 10);
+
+    $deadline = microtime(true) + $timeout;
+
+    $data = isset($data) ? $data : '';
+
+    $current = isset($_APP[$key]) ? (string)$_APP[$key] : '';
+
+    while (($current === $value) && (microtime(true) < $deadline)) {
+
+        usleep(50000);
+
+        $latest = file_exists(DATA_FILE) ? file_get_contents(DATA_FILE) : '';
+
+        $latestApp = ($latest !== $data) ? unserialize($latest) : false;
+
+        if (is_array($latestApp)) {
+
+            // Files caught part way through being written fail to unserialize, and are skipped
+
+            $data = $latest;
+
+            $current = isset($latestApp[$key]) ? (string)$latestApp[$key] : '';
+
+        }
+
+    }
+
+    print $current;
+
+    exit;
+
+
+
+  case 'cas':
+
+    // Set the dictionary value only if it currently holds the expected value
+
+    $expected = isset($_GET['expected']) ? $_GET['expected'] : '';
+
+    $current = isset($_APP[$key]) ? (string)$_APP[$key] : '';
+
+    if ($current === $expected) {
+
+        $_APP[$key] = $value;
+
+        print '1';
+
+    } else {
+
+        print '0';
+
+    }
+
+    break;
+
+
+
+  case 'incr':
+
+    // Add to the dictionary value, and return the result
+
+    $by = isset($_GET['by']) ? (int)$_GET['by'] : 1;
+
+    $_APP[$key] = (string)((isset($_APP[$key]) ? (int)$_APP[$key] : 0) + $by);
+
+    print $_APP[$key];
+
+    break;
+
+
+
   default:
 
     // for any other action, just print out
@@ -249,6 +467,16 @@ if ($file)
 
 }
 
+if ($lock)
+
+{
+
+	flock($lock, LOCK_UN);
+
+	fclose($lock);
+
+}
+
 
 
 
@@ -1,31 +1,527 @@
 """
 
 Server proxy module, for providing local functions that execute the three remote
-functions of IMServer.php. That is: SET, GET and UNSET.
+functions of IMServer.php. That is: SET, GET and UNSET. Several of these may also be
+combined into a single request with the BATCH function, and WATCH waits on the server
+for a value to change, rather than repeatedly polling it. CAS and INCR change a value
+atomically on the server.
+
+IMServerProxy can also keep a bounded cache of the values it has read and written. Each
+value is tagged by the server with an ETag (the quoted MD5 hash of the value), so a cached
+value is revalidated with If-None-Match, and returned without its body if it is unchanged.
+
+AsyncIMServerProxy provides the same functions as coroutines, over a pool of connections
+on the asyncio event loop, so that one process may drive many sessions at once.
+
+Requests are sent over a bounded pool of persistent HTTP/1.1 connections, so
+consecutive dictionary operations reuse an open TCP (and TLS) connection rather
+than paying for a new handshake every time.
 
 """
 
 
 # Import URL library
+import asyncio, collections, hashlib, http.client, json, threading, time
 import urllib.request, urllib.error, urllib.parse
 from urllib.parse import quote as enc
 
+
+def batchQuery(get, values, unset, clear):
+  """
+  Builds the query string for a BATCH request.
+  """
+  query = ['action=batch']
+  if clear:
+    query.append('clear=1')
+  query += ['unset[]=%s'%(enc(key)) for key in unset]
+  for (key, value) in values.items():
+    query += ['setkey[]=%s'%(enc(key)), 'setvalue[]=%s'%(enc(value))]
+  query += ['get[]=%s'%(enc(key)) for key in get]
+  return '&'.join(query)
+
+def etag(value):
+  """
+  Gets the ETag the server gives a value - the quoted MD5 hash of the value.
+  """
+  if isinstance(value, str):
+    value = value.encode()
+  return '"%s"'%(hashlib.md5(value).hexdigest())
+
+def batchResult(body, get):
+  """
+  Decodes the response to a BATCH request into a dictionary of each key read to its value.
+  """
+  result = json.loads(body or b'{}')
+  return {key: result.get(key, '').encode() for key in get}
+
+
+class ConnectionPool:
+  """
+  A bounded pool of persistent HTTP/1.1 connections, kept separately for each host.
+
+  size: The maximum number of idle connections kept open per host.
+  idle_timeout: Seconds an idle connection may be kept before it is discarded.
+  timeout: The default socket timeout, in seconds, for each request.
+  """
+
+  def __init__(self, size=4, idle_timeout=30.0, timeout=30.0):
+    self.size = size
+    self.idle_timeout = idle_timeout
+    self.timeout = timeout
+    self._idle = {}  # (scheme, host) -> [(connection, time last used), ...]
+    self._lock = threading.Lock()
+
+  def acquire(self, scheme, host):
+    """
+    Takes an idle connection to the host from the pool, or opens a new one.
+
+    Returns: The connection, and True if it was reused from the pool.
+    """
+    now = time.monotonic()
+    with self._lock:
+      idle = self._idle.get((scheme, host), [])
+      while idle:
+        (connection, lastUsed) = idle.pop()
+        if (now - lastUsed < self.idle_timeout):
+          return (connection, True)
+        connection.close()
+
+    if (scheme == 'https'):
+      return (http.client.HTTPSConnection(host, timeout=self.timeout), False)
+    return (http.client.HTTPConnection(host, timeout=self.timeout), False)
+
+  def release(self, scheme, host, connection):
+    """
+    Returns a connection to the pool, closing it if the pool for that host is full.
+    """
+    with self._lock:
+      idle = self._idle.setdefault((scheme, host), [])
+      if (len(idle) < self.size):
+        idle.append((connection, time.monotonic()))
+        return
+    connection.close()
+
+  def request(self, scheme, host, path, timeout=None, headers=None):
+    """
+    Performs a GET request over a pooled connection.
+    A request on a reused connection which the server has since dropped is retried once on a new connection.
+
+    Returns: The response, with its body already read into response.body.
+    """
+    for attempt in range(2):
+      (connection, reused) = self.acquire(scheme, host)
+      connection.timeout = self.timeout if timeout is None else timeout
+      if connection.sock is not None:
+        connection.sock.settimeout(connection.timeout)
+
+      try:
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        response.body = response.read()
+      except (http.client.BadStatusLine, ConnectionError):
+        connection.close()
+        if reused and (attempt == 0):
+          continue
+        raise
+      except:
+        connection.close()
+        raise
+
+      if response.will_close:
+        connection.close()
+      else:
+        self.release(scheme, host, connection)
+
+      if (response.status >= 400):
+        raise urllib.error.HTTPError('%s://%s%s'%(scheme, host, path), response.status, response.reason, response.headers, None)
+      return response
+
+  def close(self):
+    """
+    Closes every idle connection in the pool.
+    """
+    with self._lock:
+      for idle in self._idle.values():
+        for (connection, lastUsed) in idle:
+          connection.close()
+      self._idle.clear()
+
+
 class IMServerProxy:
 
-  def __init__(self, url):
+  def __init__(self, url, pool_size=4, idle_timeout=30.0, timeout=30.0, pool=None, cache_size=0, cache_ttl=0):
+    """
+    url: The URL of IMServer.php.
+    pool_size: The maximum number of idle connections kept open.
+    idle_timeout: Seconds an idle connection may be kept before it is discarded.
+    timeout: The default socket timeout, in seconds, for each request.
+    pool: A ConnectionPool to share with other proxies, used instead of creating one.
+    cache_size: The number of values to cache, evicting the least recently used, or 0 for no cache.
+    cache_ttl: Seconds a cached value is returned for without revalidating it with the server.
+    """
     self.url = url
+    parts = urllib.parse.urlsplit(url)
+    self._scheme = parts.scheme
+    self._host = parts.netloc
+    self._path = parts.path or '/'
+
+    # Proxies may share a pool, so that they share connections to the same host
+    self._pool = pool if pool is not None else ConnectionPool(pool_size, idle_timeout, timeout)
+
+    self.cache_size = cache_size
+    self.cache_ttl = cache_ttl
+    self._cache = collections.OrderedDict()  # key -> (value, ETag, time validated)
+    self._cacheLock = threading.Lock()
+
+  def _request(self, query, timeout=None, headers=None):
+    return self._pool.request(self._scheme, self._host, '%s?%s'%(self._path, query), timeout, headers)
+
+  def _cached(self, key):
+    with self._cacheLock:
+      entry = self._cache.get(key)
+      if entry is not None:
+        self._cache.move_to_end(key)
+      return entry
+
+  def _store(self, values):
+    """
+    Updates the cache with values which have just been read or written.
+
+    values: A dictionary of each key to its value.
+    """
+    if (self.cache_size <= 0):
+      return
+    now = time.monotonic()
+    with self._cacheLock:
+      for (key, value) in values.items():
+        if isinstance(value, str):
+          value = value.encode()
+        self._cache[key] = (value, etag(value), now)
+        self._cache.move_to_end(key)
+      while (len(self._cache) > self.cache_size):
+        self._cache.popitem(last=False)
+
+  def _forget(self, keys=None):
+    """
+    Removes keys from the cache, or every key if none are given.
+    """
+    with self._cacheLock:
+      if keys is None:
+        self._cache.clear()
+      for key in keys or []:
+        self._cache.pop(key, None)
+
+  def get(self, key, max_age=None):
+    """
+    Reads the value of a key, using the cache if it is enabled.
+
+    key: The key to read.
+    max_age: Seconds a cached value may be returned for without revalidating it, instead of cache_ttl.
+    Returns: The value.
+    """
+    query = 'action=get&key=%s'%(enc(key))
+    if (self.cache_size <= 0):
+      return self._request(query).body
+
+    entry = self._cached(key)
+    if entry is not None:
+      (value, tag, validated) = entry
+      if (time.monotonic() - validated < (self.cache_ttl if max_age is None else max_age)):
+        return value
+      response = self._request(query, headers={'If-None-Match': tag})
+      if (response.status == 304):
+        self._store({key: value})
+        return value
+    else:
+      response = self._request(query)
+    self._store({key: response.body})
+    return response.body
 
   def __getitem__(self, key):
-    return urllib.request.urlopen('%s?action=get&key=%s'%(self.url, enc(key))).read()
+    return self.get(key)
 
   def __setitem__(self, key, value):
-    urllib.request.urlopen('%s?action=set&key=%s&value=%s'%(self.url, enc(key), enc(value)))
+    self._request('action=set&key=%s&value=%s'%(enc(key), enc(value)))
+    self._store({key: value})
 
   def __delitem__(self, key):
-    urllib.request.urlopen('%s?action=unset&key=%s'%(self.url, enc(key)))
+    self._request('action=unset&key=%s'%(enc(key)))
+    self._store({key: b''})
 
   def clear(self):
-    urllib.request.urlopen('%s?action=clear'%(self.url))
+    self._request('action=clear')
+    self._forget()
 
   def keys(self):
-    return urllib.request.urlopen('%s?action=keys'%(self.url)).read().splitlines()
+    return self._request('action=keys').body.splitlines()
+
+  def batch(self, get=(), values={}, unset=(), clear=False):
+    """
+    Performs several operations in a single request - the clear, then every unset, then every set, then every get.
+
+    get: The keys to read.
+    values: A dictionary of the keys to set, and the values to set them to.
+    unset: The keys to remove.
+    clear: True if the dictionary should be cleared first.
+    Returns: A dictionary of each key read to its value.
+    """
+    get = list(get)
+    result = batchResult(self._request(batchQuery(get, values, unset, clear)).body, get)
+    if clear:
+      self._forget()
+    self._store(dict([(key, b'') for key in unset] + list(values.items()) + list(result.items())))
+    return result
+
+  def get_many(self, keys):
+    return self.batch(get=keys)
+
+  def set_many(self, mapping):
+    self.batch(values=mapping)
+
+  def delete_many(self, keys):
+    self.batch(unset=keys)
+
+  def watch(self, key, last_value, timeout=10):
+    """
+    Waits until the value of a key differs from its last known value, or the timeout expires.
+
+    key: The key to watch.
+    last_value: The last known value of the key.
+    timeout: The maximum number of seconds to wait.
+    Returns: The current value of the key.
+    """
+    query = 'action=watch&key=%s&value=%s&timeout=%s'%(enc(key), enc(last_value), timeout)
+    value = self._request(query, timeout + self._pool.timeout).body
+    self._store({key: value})
+    return value
+
+  def cas(self, key, expected, new):
+    """
+    Sets the value of a key, but only if it currently holds the expected value.
+
+    key: The key to set.
+    expected: The value the key must currently hold.
+    new: The value to set the key to.
+    Returns: True if the value was set, False otherwise.
+    """
+    query = 'action=cas&key=%s&expected=%s&value=%s'%(enc(key), enc(expected), enc(new))
+    if (self._request(query).body.strip() == b'1'):
+      self._store({key: new})
+      return True
+    self._forget([key])
+    return False
+
+  def incr(self, key, by=1):
+    """
+    Adds to the numeric value of a key, treating a missing value as 0.
+
+    key: The key to increment.
+    by: The amount to add.
+    Returns: The new value of the key.
+    """
+    value = int(self._request('action=incr&key=%s&by=%d'%(enc(key), by)).body)
+    self._store({key: str(value)})
+    return value
+
+  def close(self):
+    self._pool.close()
+
+
+# The parts of a response read by AsyncConnectionPool
+Response = collections.namedtuple('Response', ['status', 'reason', 'headers', 'body'])
+
+
+class AsyncConnectionPool:
+  """
+  A bounded pool of persistent HTTP/1.1 connections on the asyncio event loop, kept separately for each host.
+
+  size: The maximum number of idle connections kept open per host.
+  idle_timeout: Seconds an idle connection may be kept before it is discarded.
+  timeout: The default timeout, in seconds, for each request.
+  """
+
+  def __init__(self, size=4, idle_timeout=30.0, timeout=30.0):
+    self.size = size
+    self.idle_timeout = idle_timeout
+    self.timeout = timeout
+    self._idle = {}  # (scheme, host) -> [(reader, writer, time last used), ...]
+
+  async def acquire(self, scheme, host):
+    """
+    Takes an idle connection to the host from the pool, or opens a new one.
+
+    Returns: The connection's reader and writer, and True if it was reused from the pool.
+    """
+    now = time.monotonic()
+    idle = self._idle.get((scheme, host), [])
+    while idle:
+      (reader, writer, lastUsed) = idle.pop()
+      if (now - lastUsed < self.idle_timeout) and not reader.at_eof():
+        return (reader, writer, True)
+      writer.close()
+
+    address = urllib.parse.urlsplit('//' + host)
+    port = address.port or (443 if (scheme == 'https') else 80)
+    (reader, writer) = await asyncio.wait_for(asyncio.open_connection(address.hostname, port, ssl=(scheme == 'https') or None), self.timeout)
+    return (reader, writer, False)
+
+  def release(self, scheme, host, reader, writer):
+    """
+    Returns a connection to the pool, closing it if the pool for that host is full.
+    """
+    idle = self._idle.setdefault((scheme, host), [])
+    if (len(idle) < self.size):
+      idle.append((reader, writer, time.monotonic()))
+    else:
+      writer.close()
+
+  async def request(self, scheme, host, path, timeout=None):
+    """
+    Performs a GET request over a pooled connection.
+    A request on a reused connection which the server has since dropped is retried once on a new connection.
+
+    Returns: The Response.
+    """
+    for attempt in range(2):
+      (reader, writer, reused) = await self.acquire(scheme, host)
+      try:
+        writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\n\r\n'%(path, host)).encode('latin-1'))
+        (response, willClose) = await asyncio.wait_for(self._read(reader), self.timeout if timeout is None else timeout)
+      except (http.client.BadStatusLine, ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+        if reused and (attempt == 0):
+          continue
+        raise
+      except BaseException:
+        writer.close()
+        raise
+
+      if willClose:
+        writer.close()
+      else:
+        self.release(scheme, host, reader, writer)
+
+      if (response.status >= 400):
+        raise urllib.error.HTTPError('%s://%s%s'%(scheme, host, path), response.status, response.reason, response.headers, None)
+      return response
+
+  async def _read(self, reader):
+    """
+    Reads a response from a connection.
+
+    Returns: The Response, and True if the server will close the connection afterwards.
+    """
+    line = await reader.readline()
+    if not line:
+      raise http.client.RemoteDisconnected('Remote end closed connection without response')
+    parts = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    if (len(parts) < 2) or not parts[0].startswith('HTTP/'):
+      raise http.client.BadStatusLine(line)
+    (version, status, reason) = (parts + [''])[:3]
+
+    headers = http.client.HTTPMessage()
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      (name, sep, value) = line.decode('latin-1').partition(':')
+      headers[name.strip()] = value.strip()
+
+    connection = headers.get('Connection', '').lower()
+    willClose = (connection == 'close') or ((version == 'HTTP/1.0') and (connection != 'keep-alive'))
+
+    # The body is either chunked, of a given length, or runs until the connection closes
+    if (headers.get('Transfer-Encoding', '').lower() == 'chunked'):
+      chunks = []
+      while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if (size == 0):
+          while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+          break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+      body = b''.join(chunks)
+    elif (headers.get('Content-Length') is not None):
+      body = await reader.readexactly(int(headers['Content-Length']))
+    elif (int(status) in (204, 304)) or (100 <= int(status) < 200):
+      body = b''
+    else:
+      body = await reader.read()
+      willClose = True
+
+    return (Response(int(status), reason, headers, body), willClose)
+
+  async def close(self):
+    """
+    Closes every idle connection in the pool.
+    """
+    for idle in self._idle.values():
+      for (reader, writer, lastUsed) in idle:
+        writer.close()
+    self._idle.clear()
+
+
+class AsyncIMServerProxy:
+  """
+  The functions of IMServerProxy as coroutines. As assignment can't be awaited, values are set and
+  removed with set() and delete(), and read with either get() or await proxy[key].
+  """
+
+  def __init__(self, url, pool_size=4, idle_timeout=30.0, timeout=30.0, pool=None):
+    self.url = url
+    parts = urllib.parse.urlsplit(url)
+    self._scheme = parts.scheme
+    self._host = parts.netloc
+    self._path = parts.path or '/'
+
+    # Proxies may share a pool, so that many sessions share connections to the same host
+    self._pool = pool if pool is not None else AsyncConnectionPool(pool_size, idle_timeout, timeout)
+
+  async def _request(self, query, timeout=None):
+    return (await self._pool.request(self._scheme, self._host, '%s?%s'%(self._path, query), timeout)).body
+
+  def __getitem__(self, key):
+    return self.get(key)
+
+  async def get(self, key):
+    return await self._request('action=get&key=%s'%(enc(key)))
+
+  async def set(self, key, value):
+    await self._request('action=set&key=%s&value=%s'%(enc(key), enc(value)))
+
+  async def delete(self, key):
+    await self._request('action=unset&key=%s'%(enc(key)))
+
+  async def clear(self):
+    await self._request('action=clear')
+
+  async def keys(self):
+    return (await self._request('action=keys')).splitlines()
+
+  async def batch(self, get=(), values={}, unset=(), clear=False):
+    get = list(get)
+    return batchResult(await self._request(batchQuery(get, values, unset, clear)), get)
+
+  async def get_many(self, keys):
+    return await self.batch(get=keys)
+
+  async def set_many(self, mapping):
+    await self.batch(values=mapping)
+
+  async def delete_many(self, keys):
+    await self.batch(unset=keys)
+
+  async def watch(self, key, last_value, timeout=10):
+    query = 'action=watch&key=%s&value=%s&timeout=%s'%(enc(key), enc(last_value), timeout)
+    return await self._request(query, timeout + self._pool.timeout)
+
+  async def cas(self, key, expected, new):
+    query = 'action=cas&key=%s&expected=%s&value=%s'%(enc(key), enc(expected), enc(new))
+    return (await self._request(query)).strip() == b'1'
+
+  async def incr(self, key, by=1):
+    return int(await self._request('action=incr&key=%s&by=%d'%(enc(key), by)))
+
+  async def close(self):
+    await self._pool.close()
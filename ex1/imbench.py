@@ -0,0 +1,241 @@
+"""
+
+Load test and latency benchmark for the ex1 IM protocol.
+
+Runs a number of simulated chat pairs against a local server, each user following the
+ChatProtocol FSM (as imsession.ChatSession) and exchanging a given number of messages, then
+has every user increment a shared counter. Prints the results as a single JSON object, so
+that runs against different commits can be compared:
+
+	requests, elapsed, requestsPerSecond - every HTTP request made, and how quickly
+	latency - percentiles, in milliseconds, from a message being sent to it being displayed
+	lostMessages - messages sent but never displayed, or displayed out of order
+	lostIncrements - increments of the shared counter which the server lost
+
+Start the benchmark with:
+	$ python3 imbench.py <pairs> <messages per user> <server (optional)>
+
+where the server is "python" (imserver.py, the default) or "php" (IMserver.php on PHP's
+built-in web server), each started on a free local port, or the URL of a running server.
+
+"""
+
+import sys, os, json, time, socket, asyncio, subprocess, tempfile
+import im, imsession
+
+
+USERNAME = "b%05dxx"  # Each pair chats in the dictionary of its own username
+COUNTER_KEY = "counter"  # The key every user increments at the end of a run
+
+
+class CountingPool(im.AsyncConnectionPool):
+	"""
+	A connection pool which counts the requests made through it.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		im.AsyncConnectionPool.__init__(self, *args, **kwargs)
+		self.requests = 0
+
+	async def request(self, *args, **kwargs):
+		self.requests += 1
+		return await im.AsyncConnectionPool.request(self, *args, **kwargs)
+
+
+def startServer(kind):
+	"""
+	Starts a local server on a free port.
+
+	kind: "python" or "php".
+	Returns: The server process, and the URL of the server's script with a %s in place of the username.
+	"""
+	with socket.socket() as probe:
+		probe.bind(("127.0.0.1", 0))
+		port = probe.getsockname()[1]
+
+	directory = os.path.dirname(os.path.abspath(__file__))
+	if (kind == "php"):
+		script = os.path.join(directory, "..", "IMserver.php")
+		command = ["php", "-S", "127.0.0.1:" + str(port), script]
+	else:
+		command = [sys.executable, os.path.join(directory, "imserver.py"), "127.0.0.1", str(port), tempfile.mkdtemp()]
+	process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	# Waits for the server to start listening
+	deadline = time.monotonic() + 10
+	while True:
+		try:
+			socket.create_connection(("127.0.0.1", port), 0.1).close()
+			break
+		except OSError:
+			if (time.monotonic() > deadline) or (process.poll() is not None):
+				process.kill()
+				raise RuntimeError("The " + kind + " server couldn't be started")
+			time.sleep(0.05)
+	return (process, "http://127.0.0.1:" + str(port) + "/%s/COMP28112_ex1/IMserver.php")
+
+
+def percentile(values, fraction):
+	"""
+	Gets a percentile of a list of values, by the nearest rank.
+
+	values: The sorted list of values.
+	fraction: The percentile, as a fraction between 0 and 1.
+	Returns: The percentile, or None if there are no values.
+	"""
+	if (len(values) == 0):
+		return None
+	return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+async def runPair(index, url, pool, counter, messages, results):
+	"""
+	Runs a chat between two simulated users, recording the latency of each message delivered.
+
+	index: The number of the pair.
+	url: The URL of the server, with a %s in place of the username.
+	pool: The connection pool shared by every user.
+	counter: The AsyncIMServerProxy of the dictionary holding the shared counter.
+	messages: The number of messages each user sends.
+	results: A dictionary collecting the latencies, and the numbers of messages sent and lost.
+	"""
+	url = url%(USERNAME%(index))
+	await im.AsyncIMServerProxy(url, pool=pool).clear()
+
+	def user(name):
+		# Each message holds its sequence number and the time it was sent
+		state = {"sent": 0, "received": 0}
+
+		async def nextMessage():
+			if (state["sent"] == messages):
+				return "\\quit"
+			state["sent"] += 1
+			results["sent"] += 1
+			return "%d %f"%(state["sent"], time.monotonic())
+
+		def display(line):
+			(sender, sep, content) = line.partition(": ")
+			fields = content.split(" ")
+			if (sep == "") or (len(fields) != 2):
+				return
+			# Skipped sequence numbers are lost, and repeated ones are counted as lost updates too
+			seq = int(fields[0])
+			if (seq > state["received"] + 1):
+				results["lost"] += seq - (state["received"] + 1)
+			elif (seq <= state["received"]):
+				results["lost"] += 1
+			state["received"] = max(state["received"], seq)
+			results["latencies"].append(time.monotonic() - float(fields[1]))
+
+		session = imsession.ChatSession(im.AsyncIMServerProxy(url, pool=pool), name, nextMessage, display)
+		return (session, state)
+
+	(first, firstState) = user("alice")
+	(second, secondState) = user("bob")
+
+	# The first user resets the server before the second starts, so that the second's reset can't undo the first's join
+	await first.serverInit()
+	await asyncio.gather(first.run(), second.run())
+
+	# Messages sent which the other user never displayed are lost as well
+	results["lost"] += (firstState["sent"] - secondState["received"]) + (secondState["sent"] - firstState["received"])
+
+	await counter.incr(COUNTER_KEY)
+	await counter.incr(COUNTER_KEY)
+
+
+async def benchmark(url, pairs, messages):
+	"""
+	Runs every pair at once.
+
+	url: The URL of the server, with a %s in place of the username.
+	pairs: The number of chat pairs.
+	messages: The number of messages each user sends.
+	Returns: The dictionary of results.
+	"""
+	pool = CountingPool(size=2 * pairs)
+	results = {"latencies": [], "sent": 0, "lost": 0}
+	# The counter is kept in a dictionary shared by every pair
+	counter = im.AsyncIMServerProxy(url%("tmp"), pool=pool)
+	await counter.set(COUNTER_KEY, "0")
+	pool.requests = 0
+
+	start = time.monotonic()
+	outcomes = await asyncio.gather(*[runPair(i, url, pool, counter, messages, results) for i in range(pairs)], return_exceptions=True)
+	elapsed = time.monotonic() - start
+	requests = pool.requests
+
+	errors = [repr(outcome) for outcome in outcomes if isinstance(outcome, BaseException)]
+	count = int((await counter.get(COUNTER_KEY)).decode() or 0)
+	await pool.close()
+
+	latencies = sorted(latency * 1000 for latency in results["latencies"])
+	return {
+		"pairs": pairs,
+		"messagesPerUser": messages,
+		"requests": requests,
+		"elapsed": round(elapsed, 3),
+		"requestsPerSecond": round(requests / elapsed, 1) if (elapsed > 0) else None,
+		"messagesSent": results["sent"],
+		"messagesDelivered": len(latencies),
+		"latency": {name: (round(percentile(latencies, fraction), 3) if latencies else None) for (name, fraction) in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1)]},
+		"lostMessages": results["lost"],
+		"lostIncrements": 2 * (pairs - len(errors)) - count,
+		"errors": errors[:10],
+	}
+
+
+def commit():
+	"""
+	Returns: The git commit of the working tree, or None if it can't be found.
+	"""
+	try:
+		directory = os.path.dirname(os.path.abspath(__file__))
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=directory, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def error(code):
+	"""
+	Sends a benchmark error message to the user.
+
+	code: The error code.
+	"""
+	if (code == 1):
+		print("Incorrect usage of benchmark. Use following format:\n    $ python3 " + str(sys.argv[0]) + " <pairs> <messages per user> <python, php or server URL (optional)>")
+	elif (code == 2):
+		print("Server couldn't be started.")
+	sys.exit(1)
+
+
+if (__name__ == "__main__"):
+	# Ensures that the numbers of pairs and messages are passed in
+	if (len(sys.argv) not in [3, 4]):
+		error(1)
+	try:
+		pairs = int(sys.argv[1])
+		messages = int(sys.argv[2])
+	except ValueError:
+		error(1)
+	server = sys.argv[3] if (len(sys.argv) == 4) else "python"
+
+	# Starts a local server, unless the URL of one is given
+	process = None
+	if server in ["python", "php"]:
+		try:
+			(process, url) = startServer(server)
+		except (OSError, RuntimeError):
+			error(2)
+	else:
+		url = server if ("%s" in server) else server.rstrip("/") + "/%s/COMP28112_ex1/IMserver.php"
+
+	try:
+		results = asyncio.run(benchmark(url, pairs, messages))
+	finally:
+		if (process is not None):
+			process.kill()
+
+	results["server"] = server
+	results["commit"] = commit()
+	print(json.dumps(results))
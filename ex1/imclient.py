@@ -1,17 +1,27 @@
-import time, sys
-import im
+import sys, time
+import im, impoll
 
 
 DEFAULT_SERVER = "w81310jh"  # Default server name
 ADMIN_PASSWORD = "admin"
 ATTEMPTS = 5
-WAIT_1 = 100
-WAIT_2 = 6
+WAIT_1 = 10  # Seconds between informing the user that they are still waiting
+WAIT_2 = 6   # Number of times the user is informed before they are asked if they would like to quit
+LONG_POLL = True  # False for servers without the watch action, which are then polled instead
+CACHE_SIZE = 32  # Number of values read from the server which are cached, and revalidated rather than read again
 
 # Declares the global server and user code variables
 Server = 0
 UserCode = 0
 
+# Declares the sequence numbers of the last message sent and received in the current chat
+# Each message is stored as "<sequence number>\t<message>", so that a new message can always be told apart from the last one
+SentCount = 0
+ReceivedCount = 0
+
+# Stored in place of a user's message when they quit, so a user waiting for their first message still sees it change
+QUIT_MESSAGE = "\\quit"
+
 # Defines server and user states for the FSM
 ServerStates = {"init": 0, "run": 1, "quit": 2}
 UserStates = {"init": 0, "online": 1, "ready": 2, "waiting": 3, "quit": 4}
@@ -19,11 +29,17 @@ UserStates = {"init": 0, "online": 1, "ready": 2, "waiting": 3, "quit": 4}
 # Defines the names of the user slots on the server
 UserCodes = ["user1", "user2"]
 
+# Schedules the waits for the other user, backing off while they are idle and snapping back once they aren't
+if LONG_POLL:
+	Scheduler = impoll.BackoffScheduler(WAIT_1, 3 * WAIT_1)
+else:
+	Scheduler = impoll.BackoffScheduler(0.1, WAIT_1)
+
 
 # Establishes connection with server, returning an error if the server name can't be found
 def serverConnect(serverName):
 	try:
-		server = im.IMServerProxy("https://web.cs.manchester.ac.uk/" + serverName + "/COMP28112_ex1/IMserver.php")
+		server = im.IMServerProxy("https://web.cs.manchester.ac.uk/" + serverName + "/COMP28112_ex1/IMserver.php", cache_size=CACHE_SIZE)
 	except:
 		print("Error - " + serverName + " can't be found")
 		sys.exit()
@@ -36,14 +52,9 @@ def serverConnect(serverName):
 def serverInit(server):
 	global UserCodes
 
-	# Reset performed if the current server state is quit (meaning the server isn't currently being used)
-	if (int(server["state"]) == ServerStates["quit"]):
-		serverReset(server)
-		return
-
-	# Reset also performed if the server is not configured correctly
+	# Reset performed if the server is not configured correctly
 	keys = server.keys()
-	if ((len(keys) == 8) and (keys[0].decode() == "state")):
+	if ((len(keys) == 1 + 3 * len(UserCodes)) and (keys[0].decode() == "state")):
 		j = 1
 		for i in range(len(UserCodes)):
 			if ((keys[j].decode() == UserCodes[i] + "state") and (keys[j + 1].decode() == UserCodes[i] + "name") and (keys[j + 2].decode() == UserCodes[i] + "message")):
@@ -51,41 +62,49 @@ def serverInit(server):
 				continue
 			serverReset(server)
 			return
+
+		# Reset also performed if the current server state is quit (meaning the server isn't currently being used)
+		if (int(server["state"]) == ServerStates["quit"]):
+			serverReset(server)
 		return
 	serverReset(server)
 
-# Resets the server and adds the necessary states
+# Resets the server and adds the necessary states, in a single request
 def serverReset(server):
 	global ServerStates, UserStates, UserCodes
-	server.clear()
-	server["state"] = str(ServerStates["init"])
+	values = {"state": str(ServerStates["init"])}
 	for i in range(len(UserCodes)):
-		server[UserCodes[i] + "state"] = str(UserStates["init"])
-		server[UserCodes[i] + "name"] = ""
-		server[UserCodes[i] + "message"] = ""
+		values[UserCodes[i] + "state"] = str(UserStates["init"])
+		values[UserCodes[i] + "name"] = ""
+		values[UserCodes[i] + "message"] = ""
+	server.batch(values=values, clear=True)
 
 # Allows a new user to join the server by assigning them to one of the two user slots on the server
+# Slots are claimed with a compare-and-swap, so two users joining at once can never claim the same slot
 def serverJoin(server, username):
 	global ServerStates, UserStates, UserCodes
 
 	# Users can only join if the server isn't currently running a chat and there is a free slot
-	if (Server["state"] != ServerStates["run"]):
+	states = serverGetStates(server)
+	if (states["state"] != ServerStates["run"]):
 		for i in range(len(UserCodes)):
-			if ((int(Server[UserCodes[i] + "state"]) == UserStates["init"]) or (int(Server[UserCodes[i] + "state"]) == UserStates["quit"])):
-				# Assigns a user to a slot
-				Server[UserCodes[i] + "state"] = str(UserStates["online"])
-				Server[UserCodes[i] + "name"] = username
-				return UserCodes[i]
+			if ((states[UserCodes[i]] == UserStates["init"]) or (states[UserCodes[i]] == UserStates["quit"])):
+				# Assigns a user to a slot, unless another user claimed it first
+				if server.cas(UserCodes[i] + "state", str(states[UserCodes[i]]), str(UserStates["online"])):
+					server[UserCodes[i] + "name"] = username
+					return UserCodes[i]
 	return -1
 
 # Propogates a quit message through the server, ending the current session and cleaning resources
 def serverQuit(server):
 	global ServerStates, UserStates
+	values = {}
 	for i in range(len(UserCodes)):
-		server[UserCodes[i] + "state"] = str(UserStates["quit"])
-		server[UserCodes[i] + "name"] = ""
-		server[UserCodes[i] + "message"] = ""
-	Server["state"] = str(ServerStates["quit"])
+		values[UserCodes[i] + "state"] = str(UserStates["quit"])
+		values[UserCodes[i] + "name"] = ""
+		values[UserCodes[i] + "message"] = ""
+	values["state"] = str(ServerStates["quit"])
+	server.set_many(values)
 
 # Used to simplify code, since each string from server requires this process to be usable
 # Returns the decoded string representation with '\n's removed for the string located in the requested user indexes
@@ -94,6 +113,25 @@ def serverGetString(server, userCode, index):
 	if ((userCode in UserCodes) and (index in ["state", "name", "message"])):
 		return server[userCode + index].decode().strip()
 
+# Reads the server state, and every user state and message, in a single request
+# Returns a dictionary of "state" and each user code to its state, and each user code + "message" to its message
+def serverGetStates(server):
+	global UserCodes
+	keys = ["state"]
+	for i in range(len(UserCodes)):
+		keys += [UserCodes[i] + "state", UserCodes[i] + "message"]
+	values = server.get_many(keys)
+	states = {"state": int(values["state"])}
+	for i in range(len(UserCodes)):
+		states[UserCodes[i]] = int(values[UserCodes[i] + "state"])
+		states[UserCodes[i] + "message"] = values[UserCodes[i] + "message"].decode().strip()
+	return states
+
+# Returns the sequence number of a stored message, which is 0 if there is no message
+def messageSeq(value):
+	(seq, sep, message) = value.partition("\t")
+	return int(seq) if (sep != "") else 0
+
 
 # Checks the users states that a start can occur, which is where there are two online users
 def checkForStart():
@@ -104,13 +142,15 @@ def checkForStart():
 			start = True
 	return start
 
-# Checks the user states for a quit
+# Checks the user states for a quit, reading them from the server unless they have already been read
 # Returns 0 for no quit, 1 for a quit by current user and -1 for a quit by other user
-def checkForQuit():
+def checkForQuit(states=None):
 	global Server, UserStates, UserCodes, UserCode
+	if (states is None):
+		states = serverGetStates(Server)
 	quit = False
 	for i in range(len(UserCodes)):
-		if (int(Server[UserCodes[i] + "state"]) == UserStates["quit"]):
+		if (states[UserCodes[i]] == UserStates["quit"]):
 			quit = True
 			break
 	if (quit):
@@ -120,53 +160,55 @@ def checkForQuit():
 	return 0
 
 
-# Sends a message on the server by writing a to the current user's assigned message index
+# Sends a message on the server by writing it to the current user's assigned message index, along with the user's new state
 # If the user enters \quit, then the function calls quit() to begin the termination process
 def sendMessage(message):
-	global Server, UserStates, UserCode
+	global Server, UserStates, UserCode, SentCount
 	if (message == "\\quit"):
 		quit()
 		return
-	Server[UserCode + "message"] = message
-	Server[UserCode + "state"] = str(UserStates["waiting"])
-	time.sleep(0.25)
-
-# Outputs a message received from the other user by reading the current value in that user's assigned message index
-def getMessage(otherUserCode):
-	global Server, UserStates, UserCode
-	message = serverGetString(Server, otherUserCode, "message")
+	SentCount += 1
+	Server.set_many({UserCode + "message": str(SentCount) + "\t" + message.strip(), UserCode + "state": str(UserStates["waiting"])})
+
+# Outputs a message received from the other user, from the value in that user's assigned message index which has already been read with the states
+def getMessage(otherUserCode, states):
+	global Server, UserStates, UserCode, ReceivedCount
+	(seq, sep, message) = states[otherUserCode + "message"].partition("\t")
+	ReceivedCount = int(seq)
 	Server[UserCode + "state"] = str(UserStates["ready"])
-	time.sleep(0.25)
 	return message
 
 
 # Indicates that one user is quitting the chat, triggering the termination process
 def quit():
 	global Server, UserStates, UserCode
-	Server[UserCode + "message"] = ""
-	Server[UserCode + "state"] = str(UserStates["quit"])
-
-# Waits 0.1s, informing the user every 100 repetitions (10 seconds)
-# Users are given the opportunity to quit every 600 repetitions (60 seconds) to avoid an infinite wait
-def wait(counts):
-	global UserStates, WAIT_1, WAIT_2
-	counts[0] += 1
-	if (counts[0] == WAIT_1):
+	Server.set_many({UserCode + "message": QUIT_MESSAGE, UserCode + "state": str(UserStates["quit"])})
+
+# Waits for the value of a key on the server to change from its last known value, for as long as the scheduler allows
+# The user is informed every 10 seconds they have been waiting, and given the opportunity to quit every 60 seconds to avoid an infinite wait
+# Returns the updated number of seconds waited, and True if the states have changed since they were last read
+def wait(waited, key, lastValue):
+	global Server, Scheduler, LONG_POLL, WAIT_1, WAIT_2
+	start = time.monotonic()
+	value = impoll.poll(Server, Scheduler, key, lastValue, LONG_POLL)
+	if (value != lastValue):
+		return (waited, True)
+
+	before = waited
+	waited += time.monotonic() - start
+	if (int(waited // WAIT_1) > int(before // WAIT_1)):
 		print("Waiting for other user...")
-		counts[0] = 0
-		counts[1] += 1
-	if (counts[1] == WAIT_2):
-		counts[1] = 0
+	if (int(waited // (WAIT_1 * WAIT_2)) > int(before // (WAIT_1 * WAIT_2))):
 		print("You've been waiting a while, would you like to quit? (y/n)")
 		query = input("> ")
 		if ((query.lower() in ["y", "yes", "ok", "okay"]) or (query == "\\quit")):
 			quit()
-	time.sleep(0.1)
-	return counts
+			return (waited, True)
+	return (waited, False)
 
 
 def ChatProtocol():
-	global Server, ServerStates, UserStates, UserCode, DEFAULT_SERVER, ADMIN_PASSWORD, ATTEMPTS
+	global Server, ServerStates, UserStates, UserCode, SentCount, ReceivedCount, DEFAULT_SERVER, ADMIN_PASSWORD, ATTEMPTS
 
 	# Gives the option to enter a custom university username to access a different server
 	print("Enter the server name you want to use (press enter to use the default)")
@@ -221,56 +263,68 @@ def ChatProtocol():
 	run = True
 	while (run == True):
 		# Waits for another user to join server
-		counts = [0, 0]
-		while ((int(Server[otherUserCode + "state"]) == UserStates["init"]) or (int(Server[otherUserCode + "state"]) == UserStates["quit"])):
-			counts = wait(counts)
-			quit = checkForQuit()
+		waited = 0
+		states = serverGetStates(Server)
+		while ((states[otherUserCode] == UserStates["init"]) or (states[otherUserCode] == UserStates["quit"])):
+			(waited, changed) = wait(waited, otherUserCode + "state", str(states[otherUserCode]))
+			if changed:
+				states = serverGetStates(Server)
+			quit = checkForQuit(states)
 			if (quit != 0):
 				serverQuit(Server)
 				print("You've ended the chat\nConnection Terminated")
 				return
 
 		# Determines who joined server first, and therefore sends the first message
+		SentCount = 0
+		ReceivedCount = 0
 		if (UserCode == UserCodes[0]):
-			Server[UserCode + "state"] = str(UserStates["ready"])
+			Server.set_many({UserCode + "state": str(UserStates["ready"]), UserCode + "message": "", "state": str(ServerStates["run"])})
 		else:
-			Server[UserCode + "state"] = str(UserStates["waiting"])
-		Server["state"] = str(ServerStates["run"])
+			Server.set_many({UserCode + "state": str(UserStates["waiting"]), UserCode + "message": "", "state": str(ServerStates["run"])})
 
 		print("\nYou are talking with " + serverGetString(Server, otherUserCode, "name") + ".\n")
 
 		# Main body of protocol
 		# While the chat is still running, the current user waits for a message and then can respond
-		while (int(Server["state"]) == ServerStates["run"]):
+		# Each tick reads every state at once, and waiting watches the other user's message on the server, backing off while they are idle
+		states = serverGetStates(Server)
+		while (states["state"] == ServerStates["run"]):
 			# Waits for other user to send a message, before recieving it
-			if (int(Server[UserCode + "state"]) == UserStates["waiting"]):
-				counts = [0, 0]
-				while (int(Server[otherUserCode + "state"]) == UserStates["ready"]):
-					counts = wait(counts)
+			if (states[UserCode] == UserStates["waiting"]):
+				waited = 0
+				while (messageSeq(states[otherUserCode + "message"]) <= ReceivedCount):
+					(waited, changed) = wait(waited, otherUserCode + "message", states[otherUserCode + "message"])
+					if changed:
+						states = serverGetStates(Server)
 
 					# Checks for quit
-					quit = checkForQuit()
+					quit = checkForQuit(states)
 					if abs(quit):
 						break
 
 				# Checks for quit
-				quit = checkForQuit()
+				quit = checkForQuit(states)
 				if abs(quit):
 					break
 
 				# Displays message received from other user, checking if they have requested a quit
-				message = getMessage(otherUserCode)
+				message = getMessage(otherUserCode, states)
+				states[UserCode] = UserStates["ready"]
 				print(serverGetString(Server, otherUserCode, "name") + ": " + message)
 
 			# Sends current user's next message, checking if they have requested \quit
-			if (int(Server[UserCode + "state"]) == UserStates["ready"]):
+			if (states[UserCode] == UserStates["ready"]):
 				message = input(serverGetString(Server, UserCode, "name") + ": ")
 				sendMessage(message)
+				states = serverGetStates(Server)
 
 				# Checks for quit
-				quit = checkForQuit()
+				quit = checkForQuit(states)
 				if abs(quit):
 					break
+			else:
+				states = serverGetStates(Server)
 
 		# Ends chat and cleans up server
 		quit = checkForQuit()
@@ -284,12 +338,12 @@ def ChatProtocol():
 				serverQuit(Server)
 				run = False
 			else:
-				Server[otherUserCode + "state"] = str(UserStates["init"])
-				Server["state"] = str(ServerStates["init"])
+				Server.set_many({otherUserCode + "state": str(UserStates["init"]), UserCode + "state": str(UserStates["online"]), UserCode + "message": "", "state": str(ServerStates["init"])})
 				print("Waiting for a new user...")
 
 		if not run:
 			print("Connection Terminated")
 
 
-ChatProtocol()
\ No newline at end of file
+if (__name__ == "__main__"):
+	ChatProtocol()
@@ -0,0 +1,102 @@
+"""
+
+Polling schedulers, deciding how long each wait for a change on the IM server should last.
+
+A scheduler gives the interval of the next poll with next(), and is told whether that poll saw a
+change with record(). With long polling, the interval is the timeout of a WATCH, as the server
+answers as soon as the value changes. Otherwise it is the time slept before reading the value again.
+
+"""
+
+import random, time
+
+
+class FixedScheduler():
+	"""
+	Polls at a fixed interval.
+	"""
+
+	def __init__(self, interval):
+		"""
+		interval: The number of seconds each poll lasts.
+		"""
+		self.interval = interval
+		self.requests = 0
+		self.changes = 0
+
+	def next(self):
+		"""
+		Gets the interval of the next poll, counting it as a request.
+
+		Returns: The number of seconds the poll should last.
+		"""
+		self.requests += 1
+		return self.interval
+
+	def record(self, changed):
+		"""
+		Records the outcome of a poll.
+
+		changed: True if the poll saw a change, False if it didn't.
+		"""
+		if changed:
+			self.changes += 1
+
+	def stats(self):
+		"""
+		Returns: A dictionary of the current interval, and the number of requests made and changes seen.
+		"""
+		return {"interval": self.interval, "requests": self.requests, "changes": self.changes}
+
+
+class BackoffScheduler(FixedScheduler):
+	"""
+	Backs off exponentially, with jitter, while polls see no change, and snaps back to the
+	minimum interval as soon as one does.
+	"""
+
+	def __init__(self, minimum, maximum, factor=2, jitter=0.2):
+		"""
+		minimum: The number of seconds polls last while there is activity.
+		maximum: The most seconds a poll may last, however long there has been no activity.
+		factor: The number the interval is multiplied by after each poll without a change.
+		jitter: The fraction by which each interval is randomly varied, so that idle clients don't poll in step.
+		"""
+		FixedScheduler.__init__(self, minimum)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.factor = factor
+		self.jitter = jitter
+
+	def next(self):
+		FixedScheduler.next(self)
+		return min(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter), self.maximum)
+
+	def record(self, changed):
+		FixedScheduler.record(self, changed)
+		if changed:
+			self.interval = self.minimum
+		else:
+			self.interval = min(self.interval * self.factor, self.maximum)
+
+
+def poll(server, scheduler, key, lastValue, longPoll=True):
+	"""
+	Waits for the value of a key on the server to change from its last known value, for as long as the scheduler allows.
+
+	server: The IMServerProxy of the server.
+	scheduler: The scheduler deciding how long to wait.
+	key: The key to wait on.
+	lastValue: The last known value of the key, with surrounding whitespace removed.
+	longPoll: True to wait on the server with WATCH, False to sleep and then read the value, for servers without it.
+	Returns: The current value of the key, with surrounding whitespace removed.
+	"""
+	interval = scheduler.next()
+	if longPoll:
+		value = server.watch(key, lastValue, interval)
+	else:
+		time.sleep(interval)
+		value = server[key]
+	value = value.decode().strip()
+	scheduler.record(value != lastValue)
+	return value
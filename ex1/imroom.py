@@ -0,0 +1,142 @@
+import sys, threading
+import im, impoll
+
+
+DEFAULT_SERVER = "w81310jh"  # Default server name
+DEFAULT_ROOM = "lobby"  # Default room name
+HISTORY = 10  # Number of earlier messages shown on joining a room
+BATCH = 50  # Maximum number of messages fetched in a single request
+WAIT = 10  # Seconds that each watch on the server lasts while the room is active, backing off to three times this while it is idle
+HOLE_TIMEOUT = 5  # Seconds to wait for a message whose sequence number has been taken but which hasn't been written
+
+# Declares the global server, room and user name variables
+Server = 0
+Room = ""
+UserName = ""
+
+# Every message in a room is stored under its own sequence-numbered key, so any number of users may
+# send messages at once without overwriting each other's, and readers fetch only the messages they haven't seen
+#     room.<room>.seq  - the sequence number of the latest message in the room
+#     room.<room>.<n>  - message n, stored as "<name>\t<message>"
+
+
+# Establishes connection with server, returning an error if the server name can't be found
+def serverConnect(serverName):
+	try:
+		server = im.IMServerProxy("https://web.cs.manchester.ac.uk/" + serverName + "/COMP28112_ex1/IMserver.php")
+	except:
+		print("Error - " + serverName + " can't be found")
+		sys.exit()
+
+	print(serverName + " found and connected successfully")
+	return server
+
+# Returns the key holding the sequence number of the latest message in the current room
+def seqKey():
+	global Room
+	return "room." + Room + ".seq"
+
+# Returns the key holding the message with the given sequence number in the current room
+def messageKey(seq):
+	global Room
+	return "room." + Room + "." + str(seq)
+
+# Reads the sequence number of the latest message in the current room
+def getSeq():
+	global Server
+	value = Server[seqKey()].decode().strip()
+	return int(value) if (value != "") else 0
+
+
+# Appends a message to the current room's log
+# A sequence number is first taken atomically, so that no two messages are ever given the same one
+def sendMessage(name, message):
+	global Server
+	seq = Server.incr(seqKey())
+	Server[messageKey(seq)] = name + "\t" + message
+
+# Fetches every message after the last seen sequence number, up to the given latest one
+# Returns the list of (sequence number, name, message) for each message fetched, in order
+def getMessages(lastSeq, latestSeq):
+	global Server, BATCH, HOLE_TIMEOUT
+	messages = []
+	while (lastSeq < latestSeq):
+		seqs = list(range(lastSeq + 1, min(latestSeq, lastSeq + BATCH) + 1))
+		values = Server.get_many([messageKey(seq) for seq in seqs])
+		for seq in seqs:
+			value = values[messageKey(seq)].decode()
+
+			# A sender has taken this sequence number but not yet written its message, so waits for it to appear
+			# It is skipped if it doesn't, in case the sender has gone
+			if (value == ""):
+				value = Server.watch(messageKey(seq), "", HOLE_TIMEOUT).decode()
+			if (value != ""):
+				(name, sep, message) = value.partition("\t")
+				messages.append((seq, name, message))
+			lastSeq = seq
+	return messages
+
+
+# Waits for new messages in the current room, printing those sent by other users, until the user leaves
+def receive(lastSeq, running):
+	global Server, UserName, WAIT
+	scheduler = impoll.BackoffScheduler(WAIT, 3 * WAIT)
+	while running.is_set():
+		value = impoll.poll(Server, scheduler, seqKey(), str(lastSeq))
+		latestSeq = int(value) if (value != "") else 0
+		for (seq, name, message) in getMessages(lastSeq, latestSeq):
+			if (name != UserName):
+				print("\r" + name + ": " + message + "\n" + UserName + ": ", end="")
+		lastSeq = max(lastSeq, latestSeq)
+
+
+def RoomProtocol():
+	global Server, Room, UserName, DEFAULT_SERVER, DEFAULT_ROOM, HISTORY
+
+	# Gives the option to enter a custom university username to access a different server
+	print("Enter the server name you want to use (press enter to use the default)")
+	query = input("> ")
+	serverName = DEFAULT_SERVER
+	if (query != ""):
+		serverName = query
+
+	# Attempts to connect to the server
+	Server = serverConnect(serverName)
+
+	# Asks for a room and a username
+	print("\nEnter the room you want to join (press enter to use " + DEFAULT_ROOM + ")")
+	query = input("> ")
+	Room = DEFAULT_ROOM
+	if (query != ""):
+		Room = query.replace(" ", "")
+
+	print("\nEnter your username")
+	UserName = input("> ").replace("\t", " ")
+
+	# Shows the most recent messages in the room, then listens for new ones in the background
+	lastSeq = getSeq()
+	for (seq, name, message) in getMessages(max(lastSeq - HISTORY, 0), lastSeq):
+		print(name + ": " + message)
+	sendMessage(UserName, "has joined " + Room)
+	print("You've joined " + Room + " as " + UserName + ", enter \\quit to leave\n")
+
+	running = threading.Event()
+	running.set()
+	receiver = threading.Thread(target=receive, args=(lastSeq, running), daemon=True)
+	receiver.start()
+
+	# Sends each message entered, without waiting for the other users to read it
+	while True:
+		message = input(UserName + ": ")
+		if (message == "\\quit"):
+			break
+		if (message != ""):
+			sendMessage(UserName, message)
+
+	sendMessage(UserName, "has left " + Room)
+	running.clear()
+	print("You've left " + Room + "\nConnection Terminated")
+
+
+if (__name__ == "__main__"):
+	RoomProtocol()
@@ -0,0 +1,369 @@
+"""
+
+Python stand-in for IMserver.php, for running and load-testing the chat locally.
+
+It speaks the same ?action=get|set|unset|keys|clear|batch|watch|cas|incr query protocol, but keeps
+each user's dictionary in memory, rather than reading and rewriting its whole data file on
+every request. Changes are persisted by appending them to a log file, which is compacted
+into a snapshot of the dictionary once it has grown large, and a lock per dictionary
+ensures that concurrent writers never lose each other's updates.
+
+Start the server with:
+	$ python3 imserver.py <ip address> <port> <data directory (optional)>
+
+and point IMServerProxy at http://<ip address>:<port>/<username>/COMP28112_ex1/IMserver.php
+
+"""
+
+import sys, os, re, json, time, hashlib, threading
+import http.server
+from urllib.parse import parse_qs
+
+
+COMPACT_LIMIT = 10000  # Log records before a compaction is considered
+MAX_WATCH = 30  # Maximum number of seconds a watch may wait
+
+
+class Store():
+	"""
+	A dictionary held in memory and persisted through an append-only log.
+	"""
+
+	def __init__(self, path, compactLimit=COMPACT_LIMIT):
+		"""
+		Loads the dictionary by replaying its log, if one exists.
+
+		path: The path of the log file.
+		compactLimit: The number of log records after which the log is compacted.
+		"""
+		self._path = path
+		self._compactLimit = compactLimit
+		self._data = {}
+		self._records = 0
+		self._log = None
+
+		# Every change, and every watch, synchronises on the same condition
+		self._changed = threading.Condition()
+
+		torn = False
+		if os.path.exists(path):
+			with open(path, "r", encoding="utf-8") as log:
+				for line in log:
+					try:
+						self._apply(json.loads(line))
+					except ValueError:
+						torn = True  # A final record cut short by an interrupted write
+						break
+					self._records += 1
+
+		# Rewrites a torn log, so that new records aren't appended to the partial one
+		if torn:
+			self._compact()
+		else:
+			self._log = open(path, "a", encoding="utf-8")
+
+	def _apply(self, record):
+		"""
+		Applies a single log record to the dictionary.
+
+		record: A list of the operation, followed by its arguments.
+		"""
+		if (record[0] == "set"):
+			self._data[record[1]] = record[2]
+		elif (record[0] == "unset"):
+			self._data.pop(record[1], None)
+		elif (record[0] == "clear"):
+			self._data.clear()
+
+	def _write(self, records):
+		"""
+		Applies records to the dictionary and appends them to the log, waking any watchers.
+		Must be called while holding the lock.
+
+		records: The list of log records.
+		"""
+		if (len(records) == 0):
+			return
+		for record in records:
+			self._apply(record)
+		self._log.write("".join(json.dumps(record) + "\n" for record in records))
+		self._log.flush()
+		self._records += len(records)
+		if ((self._records > self._compactLimit) and (self._records > 2 * len(self._data))):
+			self._compact()
+		self._changed.notify_all()
+
+	def _compact(self):
+		"""
+		Replaces the log with the smallest log which recreates the current dictionary.
+		Must be called while holding the lock.
+		"""
+		temp = self._path + ".tmp"
+		with open(temp, "w", encoding="utf-8") as log:
+			for (key, value) in self._data.items():
+				log.write(json.dumps(["set", key, value]) + "\n")
+			log.flush()
+			os.fsync(log.fileno())
+		if (self._log is not None):
+			self._log.close()
+		os.replace(temp, self._path)
+		self._log = open(self._path, "a", encoding="utf-8")
+		self._records = len(self._data)
+
+	def get(self, key):
+		with self._changed:
+			return self._data.get(key, "")
+
+	def set(self, key, value):
+		with self._changed:
+			self._write([["set", key, value]])
+
+	def unset(self, key):
+		with self._changed:
+			if key in self._data:
+				self._write([["unset", key]])
+
+	def keys(self):
+		with self._changed:
+			return list(self._data)
+
+	def clear(self):
+		with self._changed:
+			self._write([["clear"]])
+
+	def batch(self, clear, unset, values, get):
+		"""
+		Atomically performs the clear, then every unset, then every set, then every get.
+
+		clear: True if the dictionary should be cleared.
+		unset: The list of keys to remove.
+		values: The list of (key, value) pairs to set.
+		get: The list of keys to read.
+		Returns: A dictionary of each key read to its value.
+		"""
+		records = [["clear"]] if clear else []
+		records += [["unset", key] for key in unset]
+		records += [["set", key, value] for (key, value) in values]
+		with self._changed:
+			self._write(records)
+			return {key: self._data.get(key, "") for key in get}
+
+	def cas(self, key, expected, value):
+		"""
+		Sets the value of a key, but only if it currently holds the expected value.
+
+		key: The key to set.
+		expected: The value the key must currently hold.
+		value: The value to set the key to.
+		Returns: True if the value was set, False otherwise.
+		"""
+		with self._changed:
+			if (self._data.get(key, "") != expected):
+				return False
+			self._write([["set", key, value]])
+			return True
+
+	def incr(self, key, by):
+		"""
+		Adds to the numeric value of a key, treating a missing or non-numeric value as 0.
+
+		key: The key to increment.
+		by: The amount to add.
+		Returns: The new value of the key.
+		"""
+		with self._changed:
+			try:
+				value = int(self._data.get(key, "")) + by
+			except ValueError:
+				value = by
+			self._write([["set", key, str(value)]])
+			return value
+
+	def watch(self, key, value, timeout):
+		"""
+		Waits until the value of a key differs from the given value, or the timeout expires.
+
+		key: The key to watch.
+		value: The last known value of the key.
+		timeout: The maximum number of seconds to wait.
+		Returns: The current value of the key.
+		"""
+		deadline = time.monotonic() + timeout
+		with self._changed:
+			while (self._data.get(key, "") == value):
+				remaining = deadline - time.monotonic()
+				if (remaining <= 0):
+					break
+				self._changed.wait(remaining)
+			return self._data.get(key, "")
+
+	def close(self):
+		with self._changed:
+			self._log.close()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	"""
+	Handles IMserver.php requests, keeping connections alive between them.
+	"""
+	protocol_version = "HTTP/1.1"
+
+	# Buffers each response so its headers and body leave in a single segment, which is flushed after every
+	# request, as otherwise Nagle's algorithm holds back the body until the client's delayed ACK arrives
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		(path, sep, query) = self.path.partition("?")
+		params = parse_qs(query, keep_blank_values=True)
+		action = params.get("action", [""])[0]
+		key = params.get("key", [""])[0]
+		value = params.get("value", [""])[0]
+
+		# Like IMserver.php, each username in the URL has a dictionary of its own
+		match = re.search(r"[a-z]\d{5}[a-z]{2}", path)
+		store = self.server.getStore(match.group(0) if match else "tmp")
+
+		contentType = "text/html; charset=UTF-8"
+		if (action == "get"):
+			# Tags the value with a hash of it, so that clients can cache it and revalidate it cheaply
+			body = store.get(key)
+			etag = '"' + hashlib.md5(body.encode()).hexdigest() + '"'
+			if (self.headers.get("If-None-Match") == etag):
+				self.send_response(304)
+				self.send_header("ETag", etag)
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return
+			self.respond(body.encode(), contentType, {"ETag": etag})
+			return
+		elif (action == "set"):
+			store.set(key, value)
+			body = ""
+		elif (action == "unset"):
+			store.unset(key)
+			body = ""
+		elif (action == "keys"):
+			body = "".join(key + "\n" for key in store.keys())
+		elif (action == "clear"):
+			store.clear()
+			body = ""
+		elif (action == "batch"):
+			setKeys = params.get("setkey[]", [])
+			setValues = params.get("setvalue[]", [])
+			values = [(setKeys[i], setValues[i] if i < len(setValues) else "") for i in range(len(setKeys))]
+			result = store.batch("clear" in params, params.get("unset[]", []), values, params.get("get[]", []))
+			body = json.dumps(result)
+			contentType = "application/json"
+		elif (action == "watch"):
+			try:
+				timeout = min(max(float(params.get("timeout", ["10"])[0]), 0), MAX_WATCH)
+			except ValueError:
+				timeout = 10
+			body = store.watch(key, value, timeout)
+		elif (action == "cas"):
+			body = "1" if store.cas(key, params.get("expected", [""])[0], value) else "0"
+		elif (action == "incr"):
+			try:
+				by = int(params.get("by", ["1"])[0])
+			except ValueError:
+				by = 1
+			body = str(store.incr(key, by))
+		else:
+			body = "<html><body><h1>COMP28112 Server: Messaging System for Healthcare Professionals</h1></body></html>"
+
+		self.respond(body.encode(), contentType)
+
+	def respond(self, body, contentType, headers={}):
+		"""
+		Sends a successful response.
+
+		body: The encoded response body.
+		contentType: The content type of the body.
+		headers: Any further headers to send.
+		"""
+		self.send_response(200)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		for (name, value) in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# Logging every request would bound the server by the speed of stderr
+		pass
+
+
+class IMServer(http.server.ThreadingHTTPServer):
+	"""
+	A threaded HTTP server holding a Store for each username.
+	"""
+	daemon_threads = True
+	request_queue_size = 1024  # Many simulated clients may connect at once
+
+	def __init__(self, address, directory="/tmp"):
+		"""
+		address: The (ip address, port) pair to listen on.
+		directory: The directory in which the log files are kept.
+		"""
+		http.server.ThreadingHTTPServer.__init__(self, address, Handler)
+		self._directory = directory
+		self._stores = {}
+		self._lock = threading.Lock()
+
+	def getStore(self, username):
+		"""
+		Gets the store for a username, loading it if it hasn't been used yet.
+
+		username: The username from the request URL.
+		Returns: The store.
+		"""
+		with self._lock:
+			if username not in self._stores:
+				self._stores[username] = Store(os.path.join(self._directory, "im." + username + ".log"))
+			return self._stores[username]
+
+	def server_close(self):
+		http.server.ThreadingHTTPServer.server_close(self)
+		with self._lock:
+			for store in self._stores.values():
+				store.close()
+
+
+
+def error(code):
+	"""
+	Sends a server error message to the user.
+
+	code: The error code.
+	"""
+	if (code == 1):
+		print("Incorrect usage of server. Use following format:\n    $ python3 " + str(sys.argv[0]) + " <ip address> <port> <data directory (optional)>")
+	elif (code == 2):
+		print("IP address or port couldn't be found.")
+	sys.exit()
+
+
+if (__name__ == "__main__"):
+	# Ensures that IP address and port are passed in
+	if (len(sys.argv) not in [3, 4]):
+		error(1)
+
+	# Parse the IP address and port you wish to listen on
+	ip = sys.argv[1]
+	port = int(sys.argv[2])
+	directory = sys.argv[3] if (len(sys.argv) == 4) else "/tmp"
+
+	try:
+		server = IMServer((ip, port), directory)
+	except OSError:
+		error(2)
+
+	print("IM server has started")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+	print("IM server has stopped")
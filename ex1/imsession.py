@@ -0,0 +1,242 @@
+"""
+
+The ChatProtocol FSM of imclient.py as a coroutine, for driving many chat sessions from one process.
+
+Rather than module-wide globals and blocking calls, each ChatSession keeps its own state and
+awaits an AsyncIMServerProxy, so thousands of sessions may run at once on a single event loop.
+Sessions may share a pool of connections by giving their proxies the same AsyncConnectionPool:
+
+	pool = im.AsyncConnectionPool()
+	server = im.AsyncIMServerProxy(url, pool=pool)
+	session = ChatSession(server, "alice", nextMessage)
+	await session.run()
+
+"""
+
+import impoll
+from imclient import ServerStates, UserStates, UserCodes, WAIT_1, WAIT_2, QUIT_MESSAGE, messageSeq
+
+
+class ChatSession():
+	"""
+	A single user's side of a chat, following the same protocol as imclient.ChatProtocol().
+	"""
+
+	def __init__(self, server, userName, nextMessage, display=print, maxWaits=WAIT_2, scheduler=None):
+		"""
+		server: The AsyncIMServerProxy of the chat server.
+		userName: The user's screen name.
+		nextMessage: A coroutine function returning the next message to send, or \\quit to end the chat.
+		display: A function called with each line of output.
+		maxWaits: The number of watches without a change after which the user gives up and quits.
+		scheduler: The impoll scheduler deciding how long each watch lasts, watching for WAIT_1 seconds at a time if not given.
+		"""
+		self.server = server
+		self.userName = userName
+		self.nextMessage = nextMessage
+		self.display = display
+		self.maxWaits = maxWaits
+		self.scheduler = scheduler if (scheduler is not None) else impoll.FixedScheduler(WAIT_1)
+
+		self.userCode = None
+		self.sentCount = 0
+		self.receivedCount = 0
+
+	async def serverInit(self):
+		"""
+		Ensures the server is set up correctly for the chat system, performing a reset otherwise.
+		"""
+		keys = [key.decode() for key in await self.server.keys()]
+		expected = ["state"]
+		for userCode in UserCodes:
+			expected += [userCode + "state", userCode + "name", userCode + "message"]
+		if ((keys != expected) or (int(await self.server.get("state")) == ServerStates["quit"])):
+			await self.serverReset()
+
+	async def serverReset(self):
+		"""
+		Resets the server and adds the necessary states, in a single request.
+		"""
+		values = {"state": str(ServerStates["init"])}
+		for userCode in UserCodes:
+			values[userCode + "state"] = str(UserStates["init"])
+			values[userCode + "name"] = ""
+			values[userCode + "message"] = ""
+		await self.server.batch(values=values, clear=True)
+
+	async def serverJoin(self):
+		"""
+		Claims a free user slot on the server with a compare-and-swap.
+
+		Returns: The user code of the slot, or None if the server is full.
+		"""
+		states = await self.getStates()
+		if (states["state"] != ServerStates["run"]):
+			for userCode in UserCodes:
+				if ((states[userCode] == UserStates["init"]) or (states[userCode] == UserStates["quit"])):
+					if await self.server.cas(userCode + "state", str(states[userCode]), str(UserStates["online"])):
+						await self.server.set(userCode + "name", self.userName)
+						return userCode
+		return None
+
+	async def serverQuit(self):
+		"""
+		Propagates a quit through the server, ending the current session.
+		"""
+		values = {"state": str(ServerStates["quit"])}
+		for userCode in UserCodes:
+			values[userCode + "state"] = str(UserStates["quit"])
+			values[userCode + "name"] = ""
+			values[userCode + "message"] = ""
+		await self.server.set_many(values)
+
+	async def getStates(self):
+		"""
+		Reads the server state, and every user state and message, in a single request.
+
+		Returns: A dictionary of "state" and each user code to its state, and each user code + "message" to its message.
+		"""
+		keys = ["state"]
+		for userCode in UserCodes:
+			keys += [userCode + "state", userCode + "message"]
+		values = await self.server.get_many(keys)
+		states = {"state": int(values["state"])}
+		for userCode in UserCodes:
+			states[userCode] = int(values[userCode + "state"])
+			states[userCode + "message"] = values[userCode + "message"].decode().strip()
+		return states
+
+	def checkForQuit(self, states):
+		"""
+		Checks the user states for a quit.
+
+		states: The states, as read by getStates().
+		Returns: 0 for no quit, 1 for a quit by this user and -1 for a quit by the other user.
+		"""
+		for userCode in UserCodes:
+			if (states[userCode] == UserStates["quit"]):
+				return 1 if (userCode == self.userCode) else -1
+		return 0
+
+	async def sendMessage(self, message):
+		"""
+		Sends a message, or starts the termination process if the message is \\quit.
+
+		message: The message to send.
+		"""
+		if (message == "\\quit"):
+			await self.quit()
+			return
+		self.sentCount += 1
+		await self.server.set_many({self.userCode + "message": str(self.sentCount) + "\t" + message.strip(), self.userCode + "state": str(UserStates["waiting"])})
+
+	async def getMessage(self, otherUserCode, states):
+		"""
+		Takes the other user's message, which has already been read with the states, and acknowledges it.
+
+		otherUserCode: The user code of the other user.
+		states: The states, as read by getStates().
+		Returns: The message.
+		"""
+		(seq, sep, message) = states[otherUserCode + "message"].partition("\t")
+		self.receivedCount = int(seq)
+		await self.server.set(self.userCode + "state", str(UserStates["ready"]))
+		return message
+
+	async def quit(self):
+		"""
+		Indicates that this user is quitting the chat.
+		"""
+		await self.server.set_many({self.userCode + "message": QUIT_MESSAGE, self.userCode + "state": str(UserStates["quit"])})
+
+	async def wait(self, count, key, lastValue):
+		"""
+		Waits for the value of a key on the server to change from its last known value.
+		Quits once maxWaits watches in a row have passed without a change.
+
+		count: The number of watches so far without a change.
+		key: The key to watch.
+		lastValue: The last known value of the key.
+		Returns: The updated count, and True if the states have changed since they were last read.
+		"""
+		value = (await self.server.watch(key, lastValue, self.scheduler.next())).decode().strip()
+		self.scheduler.record(value != lastValue)
+		if (value != lastValue):
+			return (count, True)
+
+		count += 1
+		if (count >= self.maxWaits):
+			await self.quit()
+			return (0, True)
+		return (count, False)
+
+	async def run(self):
+		"""
+		Joins the server and runs the chat until either user quits.
+
+		Returns: True if a slot on the server was joined, False if the server was full.
+		"""
+		await self.serverInit()
+		self.userCode = await self.serverJoin()
+		if (self.userCode is None):
+			self.display("Unfortunately the chat server is currently full")
+			return False
+		otherUserCode = [userCode for userCode in UserCodes if (userCode != self.userCode)][0]
+
+		# Waits for another user to join server
+		count = 0
+		states = await self.getStates()
+		while ((states[otherUserCode] == UserStates["init"]) or (states[otherUserCode] == UserStates["quit"])):
+			(count, changed) = await self.wait(count, otherUserCode + "state", str(states[otherUserCode]))
+			if changed:
+				states = await self.getStates()
+			if (self.checkForQuit(states) != 0):
+				await self.serverQuit()
+				self.display("You've ended the chat\nConnection Terminated")
+				return True
+
+		# Determines who joined server first, and therefore sends the first message
+		self.sentCount = 0
+		self.receivedCount = 0
+		state = UserStates["ready"] if (self.userCode == UserCodes[0]) else UserStates["waiting"]
+		await self.server.set_many({self.userCode + "state": str(state), self.userCode + "message": "", "state": str(ServerStates["run"])})
+
+		# Names don't change during a chat, so the other user's is only read once
+		otherName = (await self.server.get(otherUserCode + "name")).decode().strip()
+		self.display("You are talking with " + otherName + ".")
+
+		# While the chat is still running, this user waits for a message and then can respond
+		states = await self.getStates()
+		while (states["state"] == ServerStates["run"]):
+			if (states[self.userCode] == UserStates["waiting"]):
+				count = 0
+				while (messageSeq(states[otherUserCode + "message"]) <= self.receivedCount):
+					(count, changed) = await self.wait(count, otherUserCode + "message", states[otherUserCode + "message"])
+					if changed:
+						states = await self.getStates()
+					if abs(self.checkForQuit(states)):
+						break
+				if abs(self.checkForQuit(states)):
+					break
+
+				message = await self.getMessage(otherUserCode, states)
+				states[self.userCode] = UserStates["ready"]
+				self.display(otherName + ": " + message)
+
+			if (states[self.userCode] == UserStates["ready"]):
+				await self.sendMessage(await self.nextMessage())
+				states = await self.getStates()
+				if abs(self.checkForQuit(states)):
+					break
+			else:
+				states = await self.getStates()
+
+		# Ends chat and cleans up server
+		quit = self.checkForQuit(await self.getStates())
+		if (quit == 1):
+			self.display("You've ended the chat")
+		elif (quit == -1):
+			self.display(otherName + " has ended the chat")
+			await self.serverQuit()
+		self.display("Connection Terminated")
+		return True
@@ -5,113 +5,541 @@ ex2utils.py-
 
 
 import threading
-import time
+import traceback
+import collections
+import asyncio
+import inspect
+import selectors
+import concurrent.futures
 import socket as socketlib
 
 
+# The most messages gathered into a single write
+MAX_IOV = 64
+
+# Seconds to wait, when closing a socket, for its queued messages to be written to a client which isn't reading
+LINGER = 1
+
+
+def frame(msg):
+	"""Encodes a message once, to be sent with sendFrame() to any number of sockets."""
+	# Ensure a single new-line after the message
+	return msg.strip()+b"\n"
+
+
+def _sendFrames(socket, views):
+	"""Writes a list of messages with a single vectored write, returning the number of bytes written."""
+	if hasattr(socket, "sendmsg"):
+		return socket.sendmsg(views)
+	return socket.send(b"".join(views))
+
+
+def _advance(views, sent):
+	"""Returns what's left of a list of messages once the given number of bytes has been written."""
+	index = 0
+	while index < len(views) and sent >= len(views[index]):
+		sent -= len(views[index])
+		index += 1
+	views = views[index:]
+	if sent:
+		views[0] = views[0][sent:]
+	return views
+
+
+class OutboundQueue():
+	"""
+	A bounded queue of messages waiting to be written to a socket.
+	"""
+
+	def __init__(self, maxSize):
+		"""
+		maxSize: The most messages which may wait at once.
+		"""
+		self._frames = collections.deque()
+		self._offset = 0  # Bytes of the first message already written
+		self.maxSize = maxSize
+		self.peak = 0
+		self.dropped = 0
+
+	def __len__(self):
+		return len(self._frames)
+
+	def isFull(self):
+		return len(self._frames) >= self.maxSize
+
+	def put(self, frame):
+		self._frames.append(frame)
+		self.peak = max(self.peak, len(self._frames))
+
+	def popMany(self, count):
+		"""Removes and returns up to the given number of the oldest messages."""
+		return [self._frames.popleft() for i in range(min(count, len(self._frames)))]
+
+	def dropOldest(self):
+		"""Drops the oldest message which hasn't been partly written."""
+		index = 1 if self._offset else 0
+		if index < len(self._frames):
+			del self._frames[index]
+			self.dropped += 1
+
+	def clear(self):
+		self._frames.clear()
+		self._offset = 0
+
+	def write(self, socket):
+		"""
+		Writes as many of the oldest messages as the socket takes, with a single vectored write.
+
+		Returns: True if the queue is now empty.
+		"""
+		views = [memoryview(self._frames[0])[self._offset:]]
+		for index in range(1, min(MAX_IOV, len(self._frames))):
+			views.append(self._frames[index])
+		sent = self._offset + _sendFrames(socket, views)
+
+		while self._frames and sent >= len(self._frames[0]):
+			sent -= len(self._frames.popleft())
+		self._offset = sent
+		return not self._frames
+
+
 class Socket():
 	"""
 	Mutable wrapper class for sockets.
+	Sent messages wait in a bounded queue, written by a thread of the socket's own, so that
+	a client which reads slowly never holds up the sender.
 	"""
 
-	def __init__(self, socket):
+	def __init__(self, socket, maxQueue=1000, queuePolicy="disconnect"):
+		"""
+		maxQueue: The most messages which may wait to be written.
+		queuePolicy: What to do with a message sent while the queue is full - "drop" the oldest waiting
+		message, "disconnect" the client, or "block" the sender until there is room.
+		"""
 		# Store internal socket pointer
 		self._socket = socket
+		self._queue = OutboundQueue(maxQueue)
+		self._policy = queuePolicy
+		self._closing = False
+		self._writing = False
+		self.overflowed = False
+
+		# Received messages waiting for a worker, whether one is handling them, and whether onMessage has ended the connection
+		self._inbox = collections.deque()
+		self._handling = False
+		self._ended = False
+
+		# Several connections' threads may send to this socket at once
+		self._lock = threading.Condition()
 	
 	def send(self, msg):
-		# Ensure a single new-line after the message
-		self._socket.send(msg.strip()+b"\n")
+		self.sendFrame(frame(msg))
+
+	def sendFrame(self, frame):
+		"""Sends a message already encoded by frame(), which may be shared with other sockets."""
+		with self._lock:
+			if not self._makeRoom():
+				return
+			self._queue.put(frame)
+			self._lock.notify_all()
+
+	def _makeRoom(self):
+		"""Applies the queue policy if the queue is full, returning whether the message should be queued."""
+		if self._closing:
+			return False
+		if not self._queue.isFull():
+			return True
+
+		if self._policy == "drop":
+			self._queue.dropOldest()
+		elif self._policy == "block":
+			while self._queue.isFull() and not self._closing:
+				self._lock.wait()
+			return not self._closing
+		else:
+			self._overflow()
+			return False
+		return True
+
+	def _overflow(self):
+		"""Disconnects a client which can't keep up, by shutting the socket so its receiving loop ends."""
+		self.overflowed = True
+		self._closing = True
+		self._queue.clear()
+		self._lock.notify_all()
+		self._shutdown(socketlib.SHUT_RDWR)
+
+	def setQueue(self, maxQueue, queuePolicy):
+		"""Changes the most messages which may wait to be written, and what to do with more."""
+		with self._lock:
+			self._queue.maxSize = maxQueue
+			self._policy = queuePolicy
+			self._lock.notify_all()
+
+	def stats(self):
+		"""Returns: A dictionary of the messages waiting, the most that have ever waited at once and the number dropped."""
+		return {"queued": len(self._queue), "peak": self._queue.peak, "dropped": self._queue.dropped}
+
+	def _startWriter(self):
+		self._writer = threading.Thread(target = self._write, daemon = True)
+		self._writer.start()
+
+	def _write(self):
+		"""Writes queued messages until the socket closes, and then whatever can still be written."""
+		while True:
+			with self._lock:
+				while not len(self._queue) and not self._closing:
+					self._lock.wait()
+				if not len(self._queue):
+					return
+				views = [memoryview(frame) for frame in self._queue.popMany(MAX_IOV)]
+				self._writing = True
+				self._lock.notify_all()
+
+			# Every message waiting is written together
+			while len(views):
+				try:
+					views = _advance(views, _sendFrames(self._socket, views))
+				except OSError:
+					break
+
+			with self._lock:
+				self._writing = False
+				if len(views):
+					self._closing = True
+					self._queue.clear()
+				self._lock.notify_all()
+				if len(views):
+					return
+
+	def flush(self, timeout=None):
+		"""
+		Waits until every message sent has been written to the socket.
+
+		timeout: The most seconds to wait, or None to wait for as long as it takes.
+		Returns: True if every message was written, False if the timeout expired.
+		"""
+		with self._lock:
+			return self._lock.wait_for(lambda: not (len(self._queue) or self._writing), timeout)
+
+	def _finish(self):
+		"""Stops accepting messages, waits for those queued to be written, and closes the socket."""
+		with self._lock:
+			self._closing = True
+			self._lock.notify_all()
+
+		# Gives up on a client which isn't reading, by shutting the socket under the writer
+		self._writer.join(LINGER)
+		if self._writer.is_alive():
+			self._shutdown(socketlib.SHUT_RDWR)
+			self._writer.join()
+		self._socket.close()
+
+	def _shutdown(self, how=socketlib.SHUT_RD):
+		"""Shuts the socket, by default waking its receiving thread as though the client had disconnected."""
+		try:
+			self._socket.shutdown(how)
+		except OSError:
+			pass
 		
 	def close(self):
 		self._socket.close()
 		
 
+class LineReader():
+	"""
+	Splits the data received on a socket into newline delimited messages, receiving straight into a
+	preallocated buffer and decoding only whole lines, so multi-byte characters are never split.
+	"""
+
+	def __init__(self, socket, bufferSize=4096, maxLineLength=65536):
+		"""
+		socket: The socket to receive from.
+		bufferSize: The number of bytes the buffer starts with, and received at most at once.
+		maxLineLength: The most bytes a single message may have, up to which the buffer grows for long messages.
+		"""
+		self._socket = socket
+		self._bufferSize = bufferSize
+		self._maxLineLength = maxLineLength
+		self._buffer = bytearray(bufferSize)
+		self._view = memoryview(self._buffer)
+
+		# Unprocessed data lies between start and end, and has been searched for a newline up to scanned
+		self._start = 0
+		self._end = 0
+		self._scanned = 0
+
+	def read(self):
+		"""
+		Receives once from the socket, raising whatever the socket raises if there is nothing to receive.
+
+		Returns: The list of messages completed, without their newlines, or None if the connection has closed.
+		Raises: ValueError if a message is longer than the maximum line length.
+		"""
+		self._makeRoom()
+		received = self._socket.recv_into(self._view[self._end:])
+		if received == 0:
+			return None
+		self._end += received
+
+		# Only searches the data just received for newlines
+		messages = []
+		while True:
+			newline = self._buffer.find(b'\n', self._scanned, self._end)
+			if newline == -1:
+				break
+			if newline - self._start > self._maxLineLength:
+				raise ValueError("message longer than " + str(self._maxLineLength) + " bytes")
+			messages.append(str(self._view[self._start:newline], 'utf-8', 'replace'))
+			self._start = self._scanned = newline + 1
+		self._scanned = self._end
+
+		if self._end - self._start > self._maxLineLength:
+			raise ValueError("message longer than " + str(self._maxLineLength) + " bytes")
+		return messages
+
+	def _makeRoom(self):
+		"""Moves unprocessed data to the front of the buffer, growing it if it's full of a partial message."""
+		length = self._end - self._start
+		if self._start > 0:
+			self._buffer[:length] = self._buffer[self._start:self._end]
+			self._scanned -= self._start
+			self._start = 0
+			self._end = length
+
+		# Grows the buffer for a long message, and shrinks it back once the message is done
+		size = self._bufferSize
+		while size <= length:
+			size *= 2
+		if size != len(self._buffer):
+			self._view.release()
+			self._buffer = self._buffer[:length] + bytearray(size - length)
+			self._view = memoryview(self._buffer)
+
+
+class SelectorSocket(Socket):
+	"""
+	Socket wrapper for the selector backend, buffering sent data until the socket is writable.
+	"""
+
+	def __init__(self, socket, server):
+		Socket.__init__(self, socket, server.maxQueue, server.queuePolicy)
+		self._server = server
+		self._reader = LineReader(socket, server.bufferSize, server.maxLineLength)
+		self._paused = False
+		self._disconnected = False
+
+	def sendFrame(self, frame):
+		# Sent from a worker, so handed to the event loop, which owns the socket
+		if threading.get_ident() != self._server._loopThread:
+			self._server._callSoon(self.sendFrame, frame)
+			return
+
+		# Queue the message and write as much as the socket will take now, the rest once it's writable
+		# Messages are still queued while closing, to be written just before the socket closes
+		if self.overflowed:
+			return
+		if self._queue.isFull():
+			if self._policy == "drop":
+				self._queue.dropOldest()
+			elif self._policy == "block":
+				# Nothing else runs while the event loop waits, so the socket is written to until there's room,
+				# disconnecting the client if it takes nothing for LINGER seconds
+				self._server._flush(self, block = True)
+				if self.overflowed:
+					return
+			else:
+				self.overflowed = True
+				self._queue.clear()
+				self.close()
+				return
+		self._queue.put(frame)
+		self._server._flush(self)
+
+	def close(self):
+		# Closed from a worker, so handed to the event loop too
+		if threading.get_ident() != self._server._loopThread:
+			self._server._callSoon(self.close)
+			return
+
+		# Closed by the event loop, once the current callback has returned
+		if not self._closing:
+			self._closing = True
+			self._server._closed.append(self)
+
+
+class RWLock():
+	"""
+	A lock which may be held by many readers at once, or by a single writer.
+	Waiting writers are given priority over new readers, so that they aren't starved.
+	"""
+
+	def __init__(self):
+		self._condition = threading.Condition(threading.Lock())
+		self._readers = 0
+		self._writing = False
+		self._writersWaiting = 0
+
+	def acquireRead(self):
+		with self._condition:
+			while self._writing or self._writersWaiting:
+				self._condition.wait()
+			self._readers += 1
+
+	def releaseRead(self):
+		with self._condition:
+			self._readers -= 1
+			if self._readers == 0:
+				self._condition.notify_all()
+
+	def acquireWrite(self):
+		with self._condition:
+			self._writersWaiting += 1
+			while self._writing or self._readers:
+				self._condition.wait()
+			self._writersWaiting -= 1
+			self._writing = True
+
+	def releaseWrite(self):
+		with self._condition:
+			self._writing = False
+			self._condition.notify_all()
+
+
 class Receiver():
 	"""
 	A class for receiving newline delimited text commands on a socket.
+	Each connection's events are called on its own thread, in parallel with other connections',
+	so subclasses must protect any state shared between connections.
 	"""
 
+	# The number of bytes received at once, and the longest message accepted before disconnecting
+	bufferSize = 4096
+	maxLineLength = 65536
+
+	# The most messages waiting to be sent to each socket, and what to do with more - "drop", "disconnect" or "block"
+	maxQueue = 1000
+	queuePolicy = "disconnect"
+
 	def __init__(self):
-		# Protect access
-		self._lock = threading.RLock()
-		self._running = True
+		# Written to by stop(), to wake a server waiting for connections
+		(self._wakeReader, self._wakeWriter) = socketlib.socketpair()
+		self._wakeReader.setblocking(False)
+		self._wakeWriter.setblocking(False)
 
-	def __call__(self, socket):
-		"""Called for a connection."""
-		# Set timeout on socket operations
-		socket.settimeout(1)
+		# Every connection's thread
+		self._threads = set()
+
+		# Every connected socket, and the queue statistics of those which have disconnected
+		self._connections = set()
+		self._statsLock = threading.Lock()
+		self._retired = {"dropped": 0, "overflowed": 0}
+
+		# Checked by every connection's loop, so kept lock-free
+		self._running = threading.Event()
+		self._running.set()
 
+	def __call__(self, socket, wrappedSocket=None):
+		"""Called for a connection, whose socket may already have been wrapped."""
+		# Block on socket operations, as stop() wakes the connection by shutting its socket
+		socket.settimeout(None)
 
-		# Wrap socket for events
-		wrappedSocket = Socket(socket)
+
+		# Wrap socket for events, with a thread writing what's sent to it
+		if wrappedSocket is None:
+			wrappedSocket = Socket(socket, self.maxQueue, self.queuePolicy)
+			wrappedSocket._startWriter()
+		self._addConnection(wrappedSocket)
 		
-		# Store the unprocessed data
-		stored = ''
-		chunk = ''
+		# Split the received data into messages
+		reader = LineReader(socket, self.bufferSize, self.maxLineLength)
+		success = True
 		
 		# On connect!
-		self._lock.acquire()
 		self.onConnect(wrappedSocket)
-		self._lock.release()
 		
 		# Loop so long as the receiver is still running
-		while self.isRunning():
-		
-			# Take everything up to the first newline of the stored data
-			(message, sep, rest) = stored.partition('\n')
+		while success and self.isRunning():
+			try:
+				messages = reader.read()
+			except (OSError, ValueError):
+				break
 			
-			if sep == '': # If no newline is found, store more data...
-				while self.isRunning():
-					
-					try:
-						chunk = ''
-						chunk = socket.recv(1024).decode() 
-						stored += chunk
-						break
-					except socketlib.timeout:
-						pass
-					except:
-						print('EXCEPTION')
-				
-				# Empty chunk means disconnect
-				if chunk == '':
-					break;
+			# None means disconnect
+			if messages is None:
+				break
 
-				continue
-			else: # ...otherwise store the rest
-				
-				stored = rest			
-				
-			# Process the command
-			self._lock.acquire()
-			success = self.onMessage(wrappedSocket, message)
-			self._lock.release()
-			
-			if not success:
-				break;
+			# Process every command received
+			for message in messages:
+				success = self._dispatch(wrappedSocket, message)
+				if not success:
+					break
 
 		# On disconnect!
-		self._lock.acquire()
-		self.onDisconnect(wrappedSocket)		
-		self._lock.release()
-		socket.close()
+		self._settle(wrappedSocket)
+		self.onDisconnect(wrappedSocket)
+		wrappedSocket._finish()
+		self._removeConnection(wrappedSocket)
 		del socket
 		
 		# On join!
 		self.onJoin()
+
+		# Finished, so needn't be waited for
+		with self._statsLock:
+			self._threads.discard(threading.current_thread())
 			
 	def stop(self):
-		"""Stop this receiver."""
-		self._lock.acquire()
-		self._running = False
-		self._lock.release()
+		"""Stop this receiver, waking it if it's waiting."""
+		self._running.clear()
+		try:
+			self._wakeWriter.send(b'\0')
+		except OSError:
+			pass
 		
 	def isRunning(self):
 		"""Is this receiver still running?"""
-		self._lock.acquire()
-		running = self._running
-		self._lock.release()
-		return running
+		return self._running.is_set()
+
+	def _handle(self, socket, message):
+		"""Passes a received message to onMessage."""
+		return self.onMessage(socket, message)
+
+	def _dispatch(self, socket, message):
+		"""Handles a message as it's received, returning False to disconnect."""
+		return self._handle(socket, message)
+
+	def _settle(self, socket):
+		"""Called before a socket disconnects, once it has stopped receiving."""
+		pass
+
+	def queueStats(self):
+		"""
+		Gets statistics of the messages waiting to be sent.
+
+		Returns: A dictionary of the number of connections, the messages waiting across them all and in the
+		longest queue, and the messages dropped and clients disconnected for falling behind since the start.
+		"""
+		with self._statsLock:
+			connections = list(self._connections)
+			stats = {"connections": len(connections), "queued": 0, "longest": 0}
+			stats.update(self._retired)
+		for connection in connections:
+			queued = len(connection._queue)
+			stats["queued"] += queued
+			stats["longest"] = max(stats["longest"], queued)
+			stats["dropped"] += connection._queue.dropped
+		return stats
+
+	def _addConnection(self, wrappedSocket):
+		with self._statsLock:
+			self._connections.add(wrappedSocket)
+
+	def _removeConnection(self, wrappedSocket):
+		with self._statsLock:
+			self._connections.discard(wrappedSocket)
+			self._retired["dropped"] += wrappedSocket._queue.dropped
+			self._retired["overflowed"] += wrappedSocket.overflowed
 		
 	def onConnect(self, socket):
 		pass
@@ -129,41 +557,392 @@ class Receiver():
 		
 class Server(Receiver):
 
-	def start(self, ip, port):
+	# The number of worker threads onMessage is called on, or None to call it on the thread which received the message
+	# Each connection's messages are still handled one at a time, in the order they were received
+	workers = None
+
+	# The most received messages which may wait for a worker, beyond which no more are received until they catch up
+	maxPending = 10000
+
+	# True to let other processes listen on the same port, with the kernel sharing connections between them
+	reusePort = False
+
+	def __init__(self):
+		Receiver.__init__(self)
+
+		# The number of messages waiting for a worker, and the sockets not being read until the workers catch up
+		self._pending = 0
+		self._paused = []
+		self._pendingLock = threading.Condition()
+
+	def start(self, ip, port, backend="threads"):
+		"""
+		Starts the server, returning once it has stopped.
+
+		backend: "threads" to handle each connection on a thread of its own, or "selectors" to handle
+		every connection on the calling thread with the selectors module (epoll on Linux).
+		"""
+		# Messages handled by a pool of workers, while sockets are read and written by the backend's own threads
+		self._backend = backend
+		self._executor = None
+		if self.workers:
+			self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, "worker")
+
 		# Set up server socket
 		serversocket = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
 		serversocket.setsockopt(socketlib.SOL_SOCKET, socketlib.SO_REUSEADDR, 1)
+		if self.reusePort:
+			serversocket.setsockopt(socketlib.SOL_SOCKET, socketlib.SO_REUSEPORT, 1)
 		serversocket.bind((ip, int(port)))
-		serversocket.listen(10)
-		serversocket.settimeout(1)
+		serversocket.listen(socketlib.SOMAXCONN)
+		serversocket.setblocking(False)
+
+		if backend == "selectors":
+			self._startSelector(serversocket)
+			return
+
+		# Wait for either a connection or stop()
+		selector = selectors.DefaultSelector()
+		selector.register(serversocket, selectors.EVENT_READ)
+		selector.register(self._wakeReader, selectors.EVENT_READ)
 		
 		# On start!
 		
 		self.onStart()
 
 		# Main connection loop
-		threads = []
 		while self.isRunning():
 			
 			try:
-				(socket, address) = serversocket.accept()								
-				thread = threading.Thread(target = self, args = (socket,))
-				threads.append(thread)
-				thread.start()
+				for (key, events) in selector.select():
+					if key.fileobj is serversocket:
+						(socket, address) = serversocket.accept()
+						thread = threading.Thread(target = self, args = (socket,))
+						with self._statsLock:
+							self._threads.add(thread)
+						thread.start()
 				
-			except socketlib.timeout:
+			except (BlockingIOError, InterruptedError):
 				pass
 				
 			except:
 				self.stop()
 
-		# Wait for all threads
-		while len(threads):
-			threads.pop().join()
+		# Wake every connection's thread, and wait for them all
+		with self._statsLock:
+			connections = list(self._connections)
+		for connection in connections:
+			connection._shutdown()
+		with self._statsLock:
+			threads = list(self._threads)
+		for thread in threads:
+			thread.join()
+		if self._executor is not None:
+			self._executor.shutdown()
+		selector.close()
+		serversocket.close()
+
+		# On stop!
+		self.onStop()
+
+	def _startSelector(self, serversocket):
+		"""Runs the server on a single thread, waiting on every socket at once."""
+		self._selector = selectors.DefaultSelector()
+		self._selector.register(serversocket, selectors.EVENT_READ)
+		self._selector.register(self._wakeReader, selectors.EVENT_READ)
+		self._closed = []
+
+		# Calls from workers, to be made by the event loop
+		self._loopThread = threading.get_ident()
+		self._calls = collections.deque()
+		self._woken = False
+
+		# On start!
+		self.onStart()
+
+		# Main event loop, until stop() wakes it
+		while self.isRunning():
+			try:
+				ready = self._selector.select()
+			except KeyboardInterrupt:
+				self.stop()
+				ready = []
+
+			for (key, events) in ready:
+				if key.fileobj is serversocket:
+					self._accept(serversocket)
+				elif key.fileobj is self._wakeReader:
+					self._runCalls()
+				else:
+					if events & selectors.EVENT_WRITE:
+						self._flush(key.data)
+					if events & selectors.EVENT_READ:
+						self._read(key.data)
+
+				# Disconnect any sockets which have been closed or failed
+				while len(self._closed):
+					self._disconnect(self._closed.pop())
+
+		# Wait for the workers, and then disconnect every remaining socket
+		if self._executor is not None:
+			self._executor.shutdown()
+		self._runCalls()
+		with self._statsLock:
+			connections = list(self._connections)
+		for wrappedSocket in connections:
+			self._disconnect(wrappedSocket)
+		self._selector.close()
+		serversocket.close()
 
 		# On stop!
 		self.onStop()
 
+	def _accept(self, serversocket):
+		"""Accepts every pending connection."""
+		while True:
+			try:
+				(socket, address) = serversocket.accept()
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				self.stop()
+				return
+
+			socket.setblocking(False)
+			wrappedSocket = SelectorSocket(socket, self)
+			self._selector.register(socket, selectors.EVENT_READ, wrappedSocket)
+			self._addConnection(wrappedSocket)
+
+			# On connect!
+			self.onConnect(wrappedSocket)
+
+	def _read(self, wrappedSocket):
+		"""Reads from a readable socket, processing every complete message received."""
+		if wrappedSocket._closing:
+			return
+		try:
+			messages = wrappedSocket._reader.read()
+		except (BlockingIOError, InterruptedError):
+			return
+		except (OSError, ValueError):
+			messages = None
+
+		# None means disconnect
+		if messages is None:
+			wrappedSocket.close()
+			return
+
+		# Process every command received, unless one closes the socket
+		for message in messages:
+			if wrappedSocket._closing:
+				break
+			if not self._dispatch(wrappedSocket, message):
+				wrappedSocket.close()
+
+		# Stop reading while the workers catch up
+		if self._executor is not None:
+			with self._pendingLock:
+				if self._pending >= self.maxPending and not wrappedSocket._closing:
+					wrappedSocket._paused = True
+					self._paused.append(wrappedSocket)
+			if wrappedSocket._paused:
+				self._watch(wrappedSocket)
+
+	def _flush(self, wrappedSocket, block=False):
+		"""
+		Writes as much queued data as a socket will take, waiting for it to be writable if any is left.
+
+		block: True to instead block until the socket has taken at least one message, for at most LINGER
+		seconds at a time, disconnecting a client which takes none in that time.
+		"""
+		# Data sent during onDisconnect is written once, just before the socket closes
+		if wrappedSocket._disconnected:
+			return
+		queue = wrappedSocket._queue
+		try:
+			if block:
+				wrappedSocket._socket.settimeout(LINGER)
+				try:
+					length = len(queue)
+					while len(queue) >= length:
+						queue.write(wrappedSocket._socket)
+				except socketlib.timeout:
+					# A client which has stopped reading would hold up every other, so it's treated as overflowing
+					wrappedSocket.overflowed = True
+					raise
+				finally:
+					wrappedSocket._socket.setblocking(False)
+			while len(queue) and not queue.write(wrappedSocket._socket):
+				pass
+		except (BlockingIOError, InterruptedError):
+			pass
+		except OSError:
+			queue.clear()
+			if not wrappedSocket._closing:
+				wrappedSocket.close()
+		self._watch(wrappedSocket)
+
+	def _watch(self, wrappedSocket):
+		"""Waits for a socket to be readable, unless it's paused or closing, and writable if data is queued for it."""
+		events = 0
+		if not (wrappedSocket._paused or wrappedSocket._closing):
+			events |= selectors.EVENT_READ
+		if len(wrappedSocket._queue):
+			events |= selectors.EVENT_WRITE
+
+		try:
+			key = self._selector.get_key(wrappedSocket._socket)
+		except KeyError:
+			if events:
+				self._selector.register(wrappedSocket._socket, events, wrappedSocket)
+			return
+		if not events:
+			self._selector.unregister(wrappedSocket._socket)
+		elif key.events != events:
+			self._selector.modify(wrappedSocket._socket, events, wrappedSocket)
+
+	def _disconnect(self, wrappedSocket):
+		"""Disconnects a socket, after sending whatever it can of the data buffered for it."""
+		if wrappedSocket._disconnected:
+			return
+		wrappedSocket._closing = True
+
+		# Disconnected by the worker handling the messages already received, once it has finished
+		with self._pendingLock:
+			waiting = wrappedSocket._handling
+			if waiting:
+				wrappedSocket._ended = True
+		if waiting:
+			self._watch(wrappedSocket)
+			return
+		wrappedSocket._disconnected = True
+		try:
+			self._selector.unregister(wrappedSocket._socket)
+		except KeyError:
+			pass
+
+		# On disconnect!
+		self.onDisconnect(wrappedSocket)
+		try:
+			while len(wrappedSocket._queue) and not wrappedSocket._queue.write(wrappedSocket._socket):
+				pass
+		except OSError:
+			pass
+		wrappedSocket._socket.close()
+		self._removeConnection(wrappedSocket)
+
+		# On join!
+		self.onJoin()
+
+	def _dispatch(self, wrappedSocket, message):
+		# Queues the message for the connection's worker, which is scheduled unless already handling it
+		if self._executor is None:
+			return self._handle(wrappedSocket, message)
+		with self._pendingLock:
+			if wrappedSocket._ended:
+				return False
+			wrappedSocket._inbox.append(message)
+			self._pending += 1
+			schedule = not wrappedSocket._handling
+			wrappedSocket._handling = True
+		if schedule:
+			self._executor.submit(self._work, wrappedSocket)
+
+		# Stops receiving on this connection's thread while the workers catch up
+		if self._backend == "threads":
+			with self._pendingLock:
+				while self._pending >= self.maxPending and self.isRunning():
+					self._pendingLock.wait()
+		return True
+
+	def _settle(self, wrappedSocket):
+		# Waits for the worker to finish the messages already received
+		with self._pendingLock:
+			while wrappedSocket._handling:
+				self._pendingLock.wait()
+
+	def _work(self, wrappedSocket):
+		"""Handles a connection's waiting messages in order, on a worker thread."""
+		while True:
+			with self._pendingLock:
+				if not len(wrappedSocket._inbox):
+					wrappedSocket._handling = False
+					self._pendingLock.notify_all()
+					break
+				message = wrappedSocket._inbox.popleft()
+
+			# A failed command disconnects the client, as onMessage returning False does, once its traceback is printed
+			try:
+				success = self._handle(wrappedSocket, message)
+			except Exception:
+				traceback.print_exc()
+				success = False
+
+			with self._pendingLock:
+				self._pending -= 1
+				if not success:
+					self._pending -= len(wrappedSocket._inbox)
+					wrappedSocket._inbox.clear()
+					wrappedSocket._ended = True
+				resume = len(self._paused) and self._pending < self.maxPending
+				self._pendingLock.notify_all()
+
+			if resume:
+				self._callSoon(self._resume)
+			if success:
+				continue
+			if self._backend == "threads":
+				wrappedSocket._shutdown()
+			else:
+				wrappedSocket.close()
+
+		# Finishes a disconnect which was waiting for the worker
+		if self._backend == "selectors" and wrappedSocket._ended and wrappedSocket._closing:
+			self._callSoon(self._disconnect, wrappedSocket)
+
+	def _callSoon(self, callback, *args):
+		"""Has the event loop make a call, from any thread."""
+		self._calls.append((callback, args))
+		if not self._woken:
+			self._woken = True
+			try:
+				self._wakeWriter.send(b'\0')
+			except OSError:
+				pass
+
+	def _runCalls(self):
+		"""Makes every call waiting for the event loop."""
+		# The wake-up bytes are drained before the flag is cleared, so a byte sent by a call made after the flag
+		# is cleared is never drained before its call is made, and a call made before is made by the loop below
+		try:
+			while self._wakeReader.recv(4096):
+				pass
+		except OSError:
+			pass
+		self._woken = False
+		while len(self._calls):
+			(callback, args) = self._calls.popleft()
+			callback(*args)
+
+	def _resume(self):
+		"""Reads from paused sockets again, once the workers have caught up."""
+		with self._pendingLock:
+			if self._pending >= self.maxPending:
+				return
+			paused = self._paused
+			self._paused = []
+		for wrappedSocket in paused:
+			wrappedSocket._paused = False
+			if not wrappedSocket._disconnected:
+				self._watch(wrappedSocket)
+
+	def stop(self):
+		Receiver.stop(self)
+
+		# Wakes any connection's thread waiting for the workers to catch up
+		with self._pendingLock:
+			self._pendingLock.notify_all()
+
 	def onStart(self):
 		pass
 
@@ -173,30 +952,92 @@ class Server(Receiver):
 
 
 class Client(Receiver):
+
+	# Commands are never dropped, so sending waits if the server has fallen far behind
+	queuePolicy = "block"
 	
 	def start(self, ip, port):
 		# Set up server socket
-		self._socket = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
-		self._socket.settimeout(1)
-		self._socket.connect((ip, int(port)))
+		socket = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
+		socket.settimeout(1)
+		socket.connect((ip, int(port)))
+		self.attach(socket)
+
+	def attach(self, socket):
+		"""Starts the client on an already connected socket, such as one end of a socketpair()."""
+		self._socket = socket
+
+		# Sent messages are written by a thread of their own
+		self._wrappedSocket = Socket(self._socket, self.maxQueue, self.queuePolicy)
+		self._wrappedSocket._startWriter()
+
+		# Senders waiting for replies, as [match, event, reply] lists
+		self._waiters = []
+		self._waitersLock = threading.Lock()
 
 		# On start!
 		self.onStart()
 
 		# Start listening for incoming messages
-		self._thread = threading.Thread(target = self, args = (self._socket,))
+		self._thread = threading.Thread(target = self, args = (self._socket, self._wrappedSocket))
 		self._thread.start()
 		
-	def send(self, message):
-		# Send message to server
-		self._lock.acquire()
-		self._socket.send(message.strip()+b'\n')
-		self._lock.release()
-		time.sleep(0.5)
+	def send(self, message, reply=None, timeout=None):
+		"""
+		Sends a message to the server, without waiting for it to be written.
+
+		reply: True to wait for the next message received from the server, or a function returning
+		True for the message to wait for. None by default, to not wait.
+		timeout: The most seconds to wait for the reply, or None to wait for as long as it takes.
+		Returns: The reply, or None if none was waited for or it didn't arrive in time.
+		"""
+		if not reply:
+			self._wrappedSocket.send(message)
+			return None
+
+		# Waits from before the message is sent, so that a quick reply can't be missed
+		waiter = [(lambda received: True) if (reply is True) else reply, threading.Event(), None]
+		with self._waitersLock:
+			if not self.isRunning():
+				return None
+			self._waiters.append(waiter)
+		self._wrappedSocket.send(message)
+		if not waiter[1].wait(timeout):
+			with self._waitersLock:
+				if waiter in self._waiters:
+					self._waiters.remove(waiter)
+		return waiter[2]
+
+	def flush(self, timeout=None):
+		"""
+		Waits until every message sent has been written to the server.
+
+		timeout: The most seconds to wait, or None to wait for as long as it takes.
+		Returns: True if every message was written, False if the timeout expired.
+		"""
+		return self._wrappedSocket.flush(timeout)
+
+	def _handle(self, socket, message):
+		# Hands the message to the first sender waiting for one like it, as well as onMessage
+		with self._waitersLock:
+			for waiter in self._waiters:
+				if waiter[0](message):
+					self._waiters.remove(waiter)
+					waiter[2] = message
+					waiter[1].set()
+					break
+		return self.onMessage(socket, message)
 
 	def stop(self):
-		# Stop event loop
+		# Stop event loop, waking the receiving thread by shutting the socket
 		Receiver.stop(self)
+		self._wrappedSocket._shutdown()
+
+		# Wake every sender still waiting for a reply, which won't come now
+		with self._waitersLock:
+			for waiter in self._waiters:
+				waiter[1].set()
+			self._waiters.clear()
 		
 		# Join thread
 		if self._thread != threading.currentThread():
@@ -213,3 +1054,173 @@ class Client(Receiver):
 		
 	def onJoin(self):
 		self.stop()
+
+
+
+async def _call(hook, *args):
+	"""Calls an event, awaiting its result if the event is a coroutine."""
+	result = hook(*args)
+	if inspect.isawaitable(result):
+		result = await result
+	return result
+
+
+class StreamSocket(Socket):
+	"""
+	Socket wrapper for asyncio streams.
+	"""
+
+	def __init__(self, writer):
+		self._writer = writer
+
+	def sendFrame(self, frame):
+		# Buffered by the transport, so never blocks - await drain() to wait for it to be written
+		self._writer.write(frame)
+
+	async def drain(self):
+		await self._writer.drain()
+
+	def close(self):
+		self._writer.close()
+
+
+class AsyncReceiver():
+	"""
+	A class for receiving newline delimited text commands on an asyncio stream.
+	Any of the events may be coroutines, which are awaited without blocking other connections.
+	"""
+
+	# The longest message accepted before disconnecting
+	maxLineLength = 65536
+
+	async def _receive(self, reader, writer):
+		"""Called for a connection."""
+		# Wrap stream for events
+		wrappedSocket = StreamSocket(writer)
+
+		# On connect!
+		await _call(self.onConnect, wrappedSocket)
+
+		try:
+			while True:
+				try:
+					line = await reader.readline()
+				except (ConnectionError, ValueError):
+					break
+
+				# A missing newline means disconnect
+				if not line.endswith(b'\n'):
+					break
+
+				# Process the command
+				if not await _call(self.onMessage, wrappedSocket, line[:-1].decode(errors='replace')):
+					break
+
+		finally:
+			# On disconnect!
+			await _call(self.onDisconnect, wrappedSocket)
+			writer.close()
+
+			# On join!
+			await _call(self.onJoin)
+
+	def onConnect(self, socket):
+		pass
+
+	def onMessage(self, socket, message):
+		pass
+
+	def onDisconnect(self, socket):
+		pass
+
+	def onJoin(self):
+		pass
+
+
+class AsyncServer(AsyncReceiver):
+
+	async def start(self, ip, port):
+		"""Starts the server, returning once it has stopped."""
+		self._loop = asyncio.get_running_loop()
+		self._stopping = asyncio.Event()
+		self._tasks = set()
+
+		server = await asyncio.start_server(self._connect, ip, int(port), reuse_address=True, limit=self.maxLineLength)
+
+		# On start!
+		await _call(self.onStart)
+
+		# Wait to be stopped, then disconnect every connection
+		await self._stopping.wait()
+		server.close()
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		await server.wait_closed()
+
+		# On stop!
+		await _call(self.onStop)
+
+	async def _connect(self, reader, writer):
+		task = asyncio.current_task()
+		self._tasks.add(task)
+		try:
+			await self._receive(reader, writer)
+		except asyncio.CancelledError:
+			pass  # Cancelled by stop(), once disconnected
+		finally:
+			self._tasks.discard(task)
+
+	def stop(self):
+		"""Stop this server, from any thread."""
+		self._loop.call_soon_threadsafe(self._stopping.set)
+
+	def onStart(self):
+		pass
+
+	def onStop(self):
+		pass
+
+
+class AsyncClient(AsyncReceiver):
+
+	async def start(self, ip, port):
+		# Connect to the server
+		(reader, self._writer) = await asyncio.open_connection(ip, int(port), limit=self.maxLineLength)
+		self._stopped = False
+
+		# On start!
+		await _call(self.onStart)
+
+		# Start listening for incoming messages
+		self._task = asyncio.ensure_future(self._receive(reader, self._writer))
+
+	def send(self, message):
+		# Send message to server, without waiting for it to be written
+		self._writer.write(message.strip()+b'\n')
+
+	async def flush(self):
+		# Wait until everything sent has been written
+		await self._writer.drain()
+
+	async def stop(self):
+		if self._stopped:
+			return
+		self._stopped = True
+
+		# Close the connection, ending the receiving task
+		self._writer.close()
+		if self._task is not asyncio.current_task():
+			await self._task
+
+		# On stop!
+		await _call(self.onStop)
+
+	def onStart(self):
+		pass
+
+	def onStop(self):
+		pass
+
+	async def onJoin(self):
+		await self.stop()
@@ -0,0 +1,296 @@
+"""
+
+mybus.py- Shares a chat server's users between processes listening on the same port.
+
+launch() forks the processes, each connected to a Hub in the parent through a socketpair().
+Every screen name is claimed through the hub, so names stay unique across the processes, and
+messages for users connected to other processes are passed on by it.
+"""
+
+
+import os
+import queue
+import threading
+import itertools
+import socket as socketlib
+from ex2utils import Receiver, Client
+
+
+class Hub(Receiver):
+	"""
+	The registry of every user across a group of processes, each connected to it by a Bus.
+	Each process is handled on a thread of its own, so the registry is kept under a lock.
+	"""
+
+	# Messages passed on to a process which is slow to read hold up the sender, rather than being lost
+	maxQueue = 10000
+	queuePolicy = "block"
+
+	def __init__(self):
+		Receiver.__init__(self)
+
+		# Every user in the order they connected, as [process socket, name] keyed by a number of their own,
+		# and the numbers keyed by case-normalised screen name
+		self._users = {}
+		self._names = {}
+		self._nextUser = 0
+		self._nextNumber = 0
+
+		# Every process's socket
+		self._processes = set()
+		self._lock = threading.Lock()
+
+	def onConnect(self, socket):
+		with self._lock:
+			self._processes.add(socket)
+
+	def onMessage(self, socket, message):
+		"""
+		Handles a request from a process, replying with "REPLY <request number> <result>" to those waiting for one.
+
+		socket: The process's socket.
+		message: The request.
+		Returns: True.
+		"""
+		(command, sep, parameters) = message.partition(" ")
+
+		# Broadcasts, and messages for channels, are passed on to the other processes as they are
+		if (command in ["ALL", "CHAN"]):
+			with self._lock:
+				others = [other for other in self._processes if (other is not socket)]
+			for other in others:
+				other.send(message.encode())
+			return True
+
+		if (command == "REMOVE"):
+			with self._lock:
+				self.remove(parameters)
+			return True
+
+		(request, sep, parameters) = parameters.partition(" ")
+		owner = None
+		with self._lock:
+			if (command == "CONNECT"):
+				reply = self.connect(socket)
+			elif (command == "RENAME"):
+				(oldName, sep, newName) = parameters.partition(" ")
+				reply = "OK" if self.rename(oldName, newName) else ""
+			elif (command == "USERS"):
+				reply = " ".join(user[1] for user in self._users.values() if (user[0] is not socket))
+			elif (command == "SEND"):
+				(target, sep, content) = parameters.partition(" ")
+				owner = self.route(target)
+				reply = "OK" if (owner is not None) else ""
+			else:
+				return True
+
+		# A private message reaches its recipient before the sender hears it was sent
+		if (owner is not None):
+			owner.send(("DELIVER " + target + " " + content).encode())
+		socket.send(("REPLY " + request + " " + reply).strip().encode())
+		return True
+
+	def onDisconnect(self, socket):
+		# A process which stops without removing its users takes them with it
+		with self._lock:
+			self._processes.discard(socket)
+			for (number, user) in list(self._users.items()):
+				if (user[0] is socket):
+					del self._names[user[1].casefold()]
+					del self._users[number]
+
+	def stop(self):
+		"""Stops the hub, disconnecting every process, which then stops too."""
+		Receiver.stop(self)
+		with self._lock:
+			processes = list(self._processes)
+		for process in processes:
+			process._shutdown()
+
+	def connect(self, socket):
+		"""
+		Adds a user under a placeholder name, until they join with one of their own.
+
+		socket: The socket of the user's process.
+		Returns: The first unused name of the form userN.
+		"""
+		while True:
+			name = "user" + str(self._nextUser)
+			self._nextUser += 1
+			if (name.casefold() not in self._names):
+				break
+		self._users[self._nextNumber] = [socket, name]
+		self._names[name.casefold()] = self._nextNumber
+		self._nextNumber += 1
+		return name
+
+	def rename(self, oldName, newName):
+		"""
+		Changes a user's screen name, unless another user has it. A user may change the case of their own name.
+
+		Returns: True if the user was renamed, False if the name is taken.
+		"""
+		number = self._names[oldName.casefold()]
+		if (self._names.get(newName.casefold(), number) != number):
+			return False
+		del self._names[oldName.casefold()]
+		self._names[newName.casefold()] = number
+		self._users[number][1] = newName
+		return True
+
+	def remove(self, name):
+		number = self._names.pop(name.casefold(), None)
+		if (number is not None):
+			del self._users[number]
+
+	def route(self, name):
+		"""
+		Returns: The socket of the process a user is connected to, or None if no user has the name.
+		"""
+		number = self._names.get(name.casefold())
+		if (number is None):
+			return None
+		return self._users[number][0]
+
+
+class Bus(Client):
+	"""
+	A process's connection to the hub, through which a server claims names and reaches other processes' users.
+	Requests wait for the hub's reply, while messages for this process's users are handed to a thread which
+	delivers them to the server, so a reply is never held up behind a delivery waiting for the server's lock.
+	"""
+
+	def __init__(self, server, socket):
+		"""
+		server: The server, whose deliver(), deliverToAll() and deliverToChannels() are called for messages from other processes.
+		socket: This process's end of the connection to the hub.
+		"""
+		Client.__init__(self)
+		self._server = server
+		self._hubSocket = socket
+		self._requests = itertools.count()
+		self._deliveries = queue.Queue()
+
+	def open(self):
+		"""Starts receiving from the hub."""
+		self._deliverer = threading.Thread(target = self._deliver, daemon = True)
+		self._deliverer.start()
+		self.attach(self._hubSocket)
+
+	def request(self, command, *parameters):
+		"""
+		Sends a request to the hub, waiting for its reply.
+
+		Returns: The result replied, or None if the hub has gone.
+		"""
+		number = str(next(self._requests))
+		prefix = "REPLY " + number
+		message = " ".join((command, number) + parameters)
+		reply = self.send(message.encode(), lambda received: (received == prefix) or received.startswith(prefix + " "))
+		if (reply is None):
+			return None
+		return reply[len(prefix) + 1:]
+
+	def connectUser(self):
+		"""Returns: A new user's placeholder name, or None if the hub has gone."""
+		return self.request("CONNECT") or None
+
+	def renameUser(self, oldName, newName):
+		"""Returns: True if the name was free for the user, False otherwise."""
+		return self.request("RENAME", oldName, newName) == "OK"
+
+	def removeUser(self, name):
+		"""Frees a user's name, without waiting."""
+		self.send(("REMOVE " + name).encode())
+
+	def users(self):
+		"""Returns: The name of every user of the other processes, in the order they connected."""
+		return (self.request("USERS") or "").split()
+
+	def sendTo(self, name, message):
+		"""
+		Sends a message to a user connected to another process.
+
+		Returns: True if the user was found, False otherwise.
+		"""
+		return bool(self.request("SEND", name, message))
+
+	def sendToAll(self, message):
+		"""Sends a message to every user of the other processes, without waiting."""
+		self.send(("ALL " + message).encode())
+
+	def sendToChannels(self, channelNames, message):
+		"""Sends a message to every member of any of the channels on the other processes, once each, without waiting."""
+		self.send(("CHAN " + str(len(channelNames)) + " " + " ".join(channelNames) + " " + message).encode())
+
+	def onMessage(self, socket, message):
+		if not message.startswith("REPLY "):
+			self._deliveries.put(message)
+		return True
+
+	def _deliver(self):
+		"""Delivers messages from other processes, until the bus stops."""
+		while True:
+			message = self._deliveries.get()
+			if (message is None):
+				return
+			(command, sep, parameters) = message.partition(" ")
+			if (command == "ALL"):
+				self._server.deliverToAll(parameters)
+			elif (command == "CHAN"):
+				(count, sep, parameters) = parameters.partition(" ")
+				parameters = parameters.split(" ", int(count))
+				self._server.deliverToChannels(parameters[:-1], parameters[-1])
+			elif (command == "DELIVER"):
+				(name, sep, content) = parameters.partition(" ")
+				self._server.deliver(name, content)
+
+	def onStop(self):
+		# The process can't keep names unique without the hub, so it stops too
+		self._deliveries.put(None)
+		self._server.stop()
+
+
+def launch(processes, run):
+	"""
+	Forks processes which share a hub, returning in this process once every one has finished.
+
+	processes: The number of processes to fork.
+	run: Called in each forked process with its end of the connection to the hub, to be given to a Bus.
+	"""
+	# Processes are forked before the hub starts any threads
+	pairs = [socketlib.socketpair() for i in range(processes)]
+	children = []
+	for (index, (hubEnd, processEnd)) in enumerate(pairs):
+		pid = os.fork()
+		if (pid == 0):
+			for (otherHubEnd, otherProcessEnd) in pairs:
+				otherHubEnd.close()
+				if (otherProcessEnd is not processEnd):
+					otherProcessEnd.close()
+			try:
+				run(processEnd)
+			finally:
+				os._exit(0)
+		children.append(pid)
+
+	# Each process is handled on a thread of its own
+	hub = Hub()
+	threads = []
+	for (hubEnd, processEnd) in pairs:
+		processEnd.close()
+		thread = threading.Thread(target = hub, args = (hubEnd,))
+		thread.start()
+		threads.append(thread)
+
+	# Wait for every process, stopping them all on an interrupt
+	while len(children):
+		try:
+			(pid, status) = os.wait()
+			children.remove(pid)
+		except KeyboardInterrupt:
+			hub.stop()
+		except ChildProcessError:
+			break
+	for thread in threads:
+		thread.join()
@@ -71,10 +71,13 @@ message = ""
 while run:
 	message = input()
 	print("\033[A                             \033[A")
-	client.send(message.encode())
 	if (message.upper()[0:4] == "QUIT"):
+		# Waits for the server to confirm, so its last messages are shown before the client stops
+		client.send(message.encode(), lambda received: received.startswith("You have successfully left"), 2)
 		run = False
 		print("\r", end="")
+	else:
+		client.send(message.encode())
 
 # Stops client
 client.stop()
@@ -0,0 +1,393 @@
+"""
+
+myfederation.py- Links chat servers as peers, into a single chat network.
+
+Each server links to its peers over their chat ports, upgrading the connection with "PEER <node> <secret>",
+where the secret is shared by every server of the network, so no user can pass themselves off as a server.
+Servers advertise their users to one another, so that every server has a table of which server
+each user is on. Private messages follow that table to the user's server, while broadcasts, messages
+for channels and adverts are flooded across the links, each server passing on only those it hasn't seen before.
+When two servers let users claim the same name at once, the older claim keeps it everywhere.
+"""
+
+
+import hmac
+import time
+import logging
+import threading
+import collections
+from mylog import log
+from ex2utils import Client
+
+
+# The most links a private message may cross before it's dropped
+MAX_HOPS = 32
+
+# The most messages which may wait to be sent along a link, beyond which the link is dropped, to be made again
+LINK_QUEUE = 100000
+
+
+class PeerLink(Client):
+	"""
+	A link made by this server to one of its peers.
+	"""
+
+	# Sending never waits for a peer which has fallen far behind, whose link is dropped instead, as it's then sent
+	# every user again once it's made again
+	maxQueue = LINK_QUEUE
+	queuePolicy = "disconnect"
+
+	def __init__(self, federation):
+		Client.__init__(self)
+		self._federation = federation
+		self.peer = None
+		self.finished = threading.Event()
+
+	def onStart(self):
+		self.send(("PEER " + self._federation.node + " " + self._federation._secret).encode())
+
+	def onMessage(self, socket, message):
+		# Ignores the greeting sent to every new connection, until the peer answers with its own node
+		if (self.peer is None):
+			(command, sep, node) = message.partition(" ")
+			if (command == "PEER"):
+				self._federation.link(self, node)
+			return True
+		return self._federation.receive(self, message)
+
+	def onStop(self):
+		if (self.peer is not None):
+			self._federation.unlink(self)
+		self.finished.set()
+
+
+class Federation():
+	"""
+	A server's links to its peers, and the table of every user on the other servers of the network.
+	The table is kept under a lock of its own, which is taken after the server's lock when both are needed.
+	Messages for the links are queued while holding it, and only sent once it's released, so a link which is slow
+	to take them never holds up the table.
+	"""
+
+	def __init__(self, server, node, peers, secret):
+		"""
+		server: The server, whose deliver(), deliverToAll(), deliverToChannels() and release() are called for messages from other servers.
+		node: The address peers reach this server on, which identifies it in the network.
+		peers: The addresses of the peers to link to, as (ip, port) tuples.
+		secret: The secret shared by every server of the network, which a peer must give to link to this one.
+		"""
+		self._server = server
+		self.node = node
+		self._peers = peers
+		self._secret = secret
+
+		# Every link, and the link first heard from for each other server, which messages for it are sent along
+		self._links = set()
+		self._origins = {}
+
+		# This server's adverts and broadcasts are numbered, and the highest number seen from every other server
+		# is kept, so each is only passed on once
+		self._nextSeq = 0
+		self._seen = {}
+
+		# This server's users, and every other server's, as [name, claim, number] and [node, name, claim, number]
+		# lists keyed by case-normalised screen name, with each claim being the time the name was taken
+		self._local = {}
+		self._routes = {}
+
+		self._lock = threading.Lock()
+		self._stopping = threading.Event()
+
+		# Messages waiting to be sent, as (links, encoded message) tuples, which are sent in order by one thread at a time
+		self._outbox = collections.deque()
+		self._sendLock = threading.Lock()
+
+	def open(self):
+		"""Starts linking to every peer, retrying each link every second until it's made, and again if it's lost."""
+		for (ip, port) in self._peers:
+			threading.Thread(target = self._connect, args = (ip, port), daemon = True).start()
+
+	def _connect(self, ip, port):
+		while not self._stopping.is_set():
+			link = PeerLink(self)
+			try:
+				link.start(ip, port)
+			except OSError:
+				self._stopping.wait(1)
+				continue
+			link.finished.wait()
+			self._stopping.wait(1)
+
+	def stop(self):
+		"""Stops every link made by this server."""
+		self._stopping.set()
+		with self._lock:
+			links = [link for link in self._links if isinstance(link, PeerLink)]
+		for link in links:
+			link.stop()
+
+	def admits(self, secret):
+		"""
+		Returns: True if a connection gave the network's secret, so may link to this server, False otherwise.
+		"""
+		return hmac.compare_digest(secret.encode(), self._secret.encode())
+
+	def link(self, socket, peer):
+		"""
+		Adds a link to a peer, sending it every user this server knows of.
+
+		socket: The link's socket, or the PeerLink if this server made the link.
+		peer: The peer's node.
+		"""
+		with self._lock:
+			socket.peer = peer
+			self._links.add(socket)
+			if not isinstance(socket, PeerLink):
+				socket.setQueue(LINK_QUEUE, "disconnect")
+				self._outbox.append(([socket], ("PEER " + self.node).encode()))
+			self._advertise(socket)
+		self._send()
+		log(logging.INFO, "linked", peer = peer)
+
+	def _advertise(self, socket, origin=None):
+		"""
+		Queues every user this server knows of for a link, before any later message. Must be called while holding the lock.
+
+		origin: The node of the only server whose users should be sent, or None for every server's.
+		"""
+		adverts = []
+		if (origin in [None, self.node]):
+			adverts += [(self.node, local[2], local[1], local[0]) for local in self._local.values()]
+		adverts += [(route[0], route[3], route[2], route[1]) for route in self._routes.values() if (origin in [None, route[0]])]
+
+		# Adverts are sent in the order they were made, so the peer passes each on
+		adverts.sort()
+		for (origin, seq, claim, name) in adverts:
+			self._outbox.append(([socket], ("USER " + origin + " " + str(seq) + " " + repr(claim) + " " + name).encode()))
+
+	def unlink(self, socket):
+		"""
+		Removes a lost link, along with the users of every server first heard from along it.
+		"""
+		with self._lock:
+			if (socket not in self._links):
+				return
+			self._links.discard(socket)
+			self._forget([origin for (origin, link) in self._origins.items() if (link is socket)])
+		self._send()
+		log(logging.INFO, "unlinked", peer = socket.peer)
+
+	def _forget(self, lost, source=None):
+		"""
+		Forgets servers, and their users, no longer reached along the link they were first heard from, telling every
+		other link with "LOST <node>". Must be called while holding the lock.
+
+		lost: The nodes of the servers.
+		source: The link which told this server of the loss, if any.
+		"""
+		for origin in lost:
+			del self._origins[origin]
+			del self._seen[origin]
+			self._flood("LOST " + origin, source)
+		for (key, route) in list(self._routes.items()):
+			if (route[0] in lost):
+				del self._routes[key]
+
+	def _accept(self, socket, origin, seq):
+		"""
+		Checks whether a flooded message is new, noting it as seen if so. Must be called while holding the lock.
+
+		Returns: True if the message should be handled and passed on, False if it's been seen before.
+		"""
+		if (origin == self.node) or (seq <= self._seen.get(origin, -1)):
+			return False
+		self._seen[origin] = seq
+		self._origins.setdefault(origin, socket)
+		return True
+
+	def _flood(self, message, source=None):
+		"""Queues a message for every link but the one it arrived on. Must be called while holding the lock."""
+		links = [link for link in self._links if (link is not source)]
+		if len(links):
+			self._outbox.append((links, message.encode()))
+
+	def _send(self):
+		"""
+		Sends every queued message, in the order they were queued. Must be called without holding the lock.
+		"""
+		with self._sendLock:
+			while True:
+				with self._lock:
+					if (len(self._outbox) == 0):
+						return
+					(links, encoded) = self._outbox.popleft()
+				for link in links:
+					link.send(encoded)
+
+	def _number(self):
+		seq = self._nextSeq
+		self._nextSeq += 1
+		return str(seq)
+
+	def receive(self, socket, message):
+		"""
+		Handles a message from a peer.
+
+		socket: The link the message arrived on.
+		message: The message.
+		Returns: True, so the link is kept.
+		"""
+		(command, sep, parameters) = message.partition(" ")
+
+		# A peer which can no longer reach a server is sent its users again, if this server still reaches it another way
+		if (command == "LOST"):
+			with self._lock:
+				link = self._origins.get(parameters)
+				if (link is socket):
+					self._forget([parameters], socket)
+				elif (link is not None) or (parameters == self.node):
+					self._advertise(socket, parameters)
+			self._send()
+			return True
+
+		if (command == "TO"):
+			(hops, sep, parameters) = parameters.partition(" ")
+			(name, sep, content) = parameters.partition(" ")
+			if not self._server.deliver(name, content):
+				self._forward(name, content, int(hops) - 1)
+			return True
+
+		(origin, sep, parameters) = parameters.partition(" ")
+		(seq, sep, parameters) = parameters.partition(" ")
+		if not seq.isdigit():
+			return True
+		seq = int(seq)
+
+		if (command in ["ALL", "CHAN"]):
+			with self._lock:
+				if not self._accept(socket, origin, seq):
+					return True
+				self._flood(message, socket)
+			self._send()
+			if (command == "ALL"):
+				self._server.deliverToAll(parameters)
+			else:
+				(count, sep, parameters) = parameters.partition(" ")
+				parameters = parameters.split(" ", int(count))
+				self._server.deliverToChannels(parameters[:-1], parameters[-1])
+
+		elif (command == "USER"):
+			(claim, sep, name) = parameters.partition(" ")
+			with self._lock:
+				if not self._accept(socket, origin, seq):
+					return True
+				self._flood(message, socket)
+				won = self._claim(origin, seq, float(claim), name)
+			self._send()
+
+			# The name is taken from any user of this server who has it
+			if won:
+				self._server.release(name)
+
+		elif (command == "GONE"):
+			with self._lock:
+				if not self._accept(socket, origin, seq):
+					return True
+				self._flood(message, socket)
+				route = self._routes.get(parameters.casefold())
+				if (route is not None) and (route[0] == origin):
+					del self._routes[parameters.casefold()]
+			self._send()
+
+		return True
+
+	def _claim(self, origin, seq, claim, name):
+		"""
+		Settles another server's claim to a name, the older claim winning, and the smaller node if both are as old.
+		Must be called while holding the lock.
+
+		Returns: True if the claim won, False if the name stays with a user who took it first.
+		"""
+		key = name.casefold()
+		local = self._local.get(key)
+		if (local is not None):
+			if ((local[1], self.node) < (claim, origin)):
+				return False
+			del self._local[key]
+
+		route = self._routes.get(key)
+		if (route is not None) and (route[0] != origin) and ((route[2], route[0]) < (claim, origin)):
+			return False
+
+		self._routes[key] = [origin, name, claim, seq]
+		return True
+
+	def _forward(self, name, content, hops):
+		"""Sends a private message along the link towards the server its recipient is on."""
+		with self._lock:
+			route = self._routes.get(name.casefold())
+			if (route is None) or (hops <= 0):
+				return False
+			link = self._origins.get(route[0])
+			if (link is None):
+				return False
+			self._outbox.append(([link], ("TO " + str(hops) + " " + route[1] + " " + content).encode()))
+		self._send()
+		return True
+
+	def connectUser(self):
+		"""Returns: None, as each server names its own new users."""
+		return None
+
+	def renameUser(self, oldName, newName):
+		"""
+		Claims a name for a user of this server, advertising it to the network.
+
+		Returns: True if no user of another server has the name, False otherwise.
+		"""
+		with self._lock:
+			route = self._routes.get(newName.casefold())
+			if (route is not None):
+				return False
+			self._withdraw(oldName)
+			seq = self._number()
+			claim = time.time()
+			self._local[newName.casefold()] = [newName, claim, int(seq)]
+			self._flood("USER " + self.node + " " + seq + " " + repr(claim) + " " + newName)
+		self._send()
+		return True
+
+	def removeUser(self, name):
+		"""Withdraws the advert of a user of this server who has left or been renamed."""
+		with self._lock:
+			self._withdraw(name)
+		self._send()
+
+	def _withdraw(self, name):
+		if self._local.pop(name.casefold(), None) is not None:
+			self._flood("GONE " + self.node + " " + self._number() + " " + name)
+
+	def users(self):
+		"""Returns: The name of every user of the other servers."""
+		with self._lock:
+			return [route[1] for route in self._routes.values()]
+
+	def sendTo(self, name, message):
+		"""
+		Sends a private message to a user of another server.
+
+		Returns: True if the user was found, False otherwise.
+		"""
+		return self._forward(name, message, MAX_HOPS)
+
+	def sendToChannels(self, channelNames, message):
+		"""Sends a message to every member of any of the channels on the other servers, once each."""
+		with self._lock:
+			self._flood("CHAN " + self.node + " " + self._number() + " " + str(len(channelNames)) + " " + " ".join(channelNames) + " " + message)
+		self._send()
+
+	def sendToAll(self, message):
+		"""Sends a message to every user of the other servers."""
+		with self._lock:
+			self._flood("ALL " + self.node + " " + self._number() + " " + message)
+		self._send()
@@ -0,0 +1,131 @@
+"""
+
+mylog.py- Logs a chat server's events without holding up the threads handling its users.
+
+Each event is put on a queue by the thread logging it, and written out by a thread of its own, so a
+slow terminal never holds up a command. Every event is written as a single line of its time, level
+and name, followed by its fields as key=value pairs. Events for every message are logged at TRACE,
+which is below the default level so off unless asked for, and may be sampled, so that only one in
+every so many of each is logged.
+"""
+
+
+import sys
+import queue
+import logging
+import itertools
+import logging.handlers
+
+
+# The level of events logged for every message and every recipient, below DEBUG so it's only written if asked for
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+# The most events which may wait to be written, beyond which new events are dropped
+MAX_QUEUE = 10000
+
+logger = logging.getLogger("ex2")
+
+_listener = None
+_handler = None
+_sample = 1
+_counts = {}
+
+
+class EventFormatter(logging.Formatter):
+	"""
+	Formats an event as its time, level and name, followed by its fields as key=value pairs.
+	"""
+
+	def format(self, record):
+		line = self.formatTime(record) + " " + record.levelname + " " + record.getMessage()
+		for (key, value) in getattr(record, "fields", {}).items():
+			value = str(value)
+			line += " " + key + "=" + (repr(value) if ((" " in value) or (value == "")) else value)
+		return line
+
+
+class EventQueueHandler(logging.handlers.QueueHandler):
+	"""
+	Puts events on the queue as they are, to be formatted by the thread writing them, dropping them if it's full.
+	"""
+
+	def __init__(self, eventQueue):
+		logging.handlers.QueueHandler.__init__(self, eventQueue)
+		self.dropped = 0
+
+	def prepare(self, record):
+		# Fields are never changed once logged, so may be formatted later on the writing thread
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+class EventQueueListener(logging.handlers.QueueListener):
+	"""
+	Writes events from the queue on a thread of its own, until it's stopped.
+	"""
+
+	def enqueue_sentinel(self):
+		# Waits for room, so the events already queued are still written before the thread stops
+		self.queue.put(self._sentinel)
+
+
+def start(level=logging.INFO, sample=1):
+	"""
+	Starts writing events to stdout.
+
+	level: The lowest level of event written. Is INFO by default, so TRACE events aren't.
+	sample: The one in how many of each sampled event is written. Is 1 by default, to write every one.
+	"""
+	global _listener, _handler, _sample
+	_sample = max(sample, 1)
+	_counts.clear()
+
+	eventQueue = queue.Queue(MAX_QUEUE)
+	_handler = EventQueueHandler(eventQueue)
+	writer = logging.StreamHandler(sys.stdout)
+	writer.setFormatter(EventFormatter())
+
+	logger.setLevel(level)
+	logger.propagate = False
+	logger.addHandler(_handler)
+	_listener = EventQueueListener(eventQueue, writer)
+	_listener.start()
+
+def stop():
+	"""Stops writing events, once every event already logged has been written."""
+	global _listener, _handler
+	if (_listener is None):
+		return
+	if _handler.dropped:
+		log(logging.WARNING, "dropped", events = _handler.dropped)
+	logger.removeHandler(_handler)
+	_listener.stop()
+	_listener = None
+	_handler = None
+
+def log(level, event, sampled=False, **fields):
+	"""
+	Logs an event, if its level is being written.
+
+	level: The event's level.
+	event: The event's name.
+	sampled: True if only one in every so many of the event should be written, as it happens so often. Is False by default.
+	fields: The event's details, each written as key=value.
+	"""
+	if not logger.isEnabledFor(level):
+		return
+
+	# Each sampled event is counted separately, so rarer ones are still written as often as their own number allows,
+	# by a counter which every handler thread may take the next number from without a lock
+	if (sampled and (_sample > 1)):
+		if (next(_counts.setdefault(event, itertools.count())) % _sample):
+			return
+		fields["sample"] = _sample
+
+	logger.log(level, event, extra = {"fields": fields})
@@ -1,40 +1,208 @@
+import os
 import sys
-from ex2utils import Server
+import logging
+import mylog
+from mylog import log, TRACE
+from ex2utils import Server, RWLock, frame
+from mybus import Bus, launch
+from myfederation import Federation
+
+
+# Usage errors sent to users, keyed by error code
+ERRORS = {
+	1: "You do not have access to that command. For a list of available commands, enter HELP.",
+	2: "Incorrect usage of JOIN command. Use following format:\n    JOIN <new name>",
+	3: "Incorrect usage of RENAME command. Use following format:\n    RENAME <new name>",
+	4: "Incorrect usage of MESSAGE command. Use following format:\n    MESSAGE <recipient> <message content>",
+	5: "Unrecognised command entered - check your spelling. For a list of available commands, enter HELP.",
+	6: "New name entered is unavailable - try a different name. For a list of active users, enter USERS.",
+	7: "Unrecognised name entered - check your spelling. For a list of active users, enter USERS.",
+	8: "You aren't in that channel - check your spelling. To join it, enter JOIN <#channel>.",
+	9: "Incorrect usage of PART command. Use following format:\n    PART <#channel>",
+	10: "Incorrect usage of JOIN command. Use following format:\n    JOIN <#channel>",
+}
+
+# The errors never change, so each is encoded once, to be shared between every socket it's sent to
+ERROR_FRAMES = {code: frame(message.encode()) for (code, message) in ERRORS.items()}
+
+
+class Connection():
+	"""
+	A user connected to the server, which keeps its identity while the user is renamed or others disconnect.
+	"""
+
+	def __init__(self, socket, name):
+		"""
+		socket: The user's socket.
+		name: The user's screen name.
+		"""
+		self.socket = socket
+		self.name = name
+		self.authorised = False
+
+		# Every channel the user is in
+		self.channels = set()
+
+
+class Channel():
+	"""
+	A group of users, who see each other's messages to the channel and each other's comings and goings.
+	"""
+
+	def __init__(self, name):
+		"""
+		name: The channel's name, starting with #.
+		"""
+		self.name = name
+		self.members = set()
+
+
+class Command():
+	"""
+	A command users may enter, with what it needs checked before the server runs it.
+	"""
+
+	def __init__(self, handler, arguments=0, authorised=None, writes=False, usage=None, help=(), locks=True):
+		"""
+		handler: Called with the user's connection followed by each argument. Returns False to disconnect the user.
+		arguments: The number of arguments the command takes. Is 0 by default.
+		authorised: True if only users who've joined may run the command, False if only users who haven't, or None for any user.
+		writes: True if the command changes the registry, so must not run alongside any other. Is False by default.
+		usage: The code of the error sent if an argument is missing.
+		help: The command's lines of HELP, as (syntax, description, authorised) tuples, with authorised being as above.
+		locks: False if the handler takes the registry's lock itself, so it isn't held while waiting on other processes. Is True by default.
+		"""
+		self.handler = handler
+		self.arguments = arguments
+		self.authorised = authorised
+		self.writes = writes
+		self.usage = usage
+		self.help = help
+		self.locks = locks
+
+	def parse(self, parameters):
+		"""
+		Splits the parameters entered with the command into its arguments.
+		A single argument is a name, so has any spaces removed, while the last of several takes the rest of the parameters.
+
+		parameters: The parameters entered.
+		Returns: The arguments, or None if any is missing.
+		"""
+		if (self.arguments == 0):
+			return []
+		if (self.arguments == 1):
+			arguments = [parameters.replace(" ", "")]
+		else:
+			arguments = parameters.strip().split(" ", self.arguments - 1)
+		if (len(arguments) < self.arguments) or ("" in arguments):
+			return None
+		return arguments
 
 
 class Server(Server):
+
+	# The Bus to the other processes sharing the port, or the Federation of servers linked to this one,
+	# or None if this server is on its own
+	network = None
+
 	def onStart(self):
 		"""
 		Called when the server has started.
-		Initiates list of sockets.
-		"""
-		print("Server has started")
-		self._sockets = []
+		Initiates the registry of connections, and the lock protecting it.
+		"""
+		log(logging.INFO, "started")
+
+		# Every connection, keyed by its socket and by its case-normalised screen name
+		self._sockets = {}
+		self._names = {}
+		self._nextUser = 0
+
+		# Names being claimed from the other processes or servers, keyed by case-normalised name, so no other
+		# user of this server may take them meanwhile
+		self._claims = {}
+
+		# Every channel, keyed by its case-normalised name
+		self._channels = {}
+
+		# Commands run in parallel on each connection's thread, only excluding each other while the registry changes
+		self._socketsLock = RWLock()
+
+		# Every command, keyed by its verb, and the HELP sent to users who have and haven't joined, encoded once
+		self._commands = {}
+		self._helpFrames = {}
+		self.addCommand("HELP", Command(self.help, help = [("HELP", "Get list of available commands", None)]))
+		self.addCommand("USERS", Command(self.users, help = [("USERS", "Get a list of all users currently online", None)]))
+		self.addCommand("RENAME", Command(self.rename, 1, authorised = True, usage = 3, locks = False,
+			help = [("RENAME <new name>", "Change your screen name", True)]))
+		self.addCommand("JOIN", Command(self.join, 1, usage = 2, locks = False, help = [
+			("JOIN <new name>", "Join the chat server with a unique screen name", False),
+			("JOIN <#channel>", "Join a channel, starting it if nobody is in it", True)]))
+		self.addCommand("PART", Command(self.part, 1, authorised = True, writes = True, usage = 9,
+			help = [("PART <#channel>", "Leave a channel", True)]))
+		self.addCommand("MESSAGE", Command(self.message, 2, authorised = True, usage = 4, help = [
+			("MESSAGE <recipient> <message content>", "Send a message to the recipient (use ALL to send a message to everyone, or a #channel to send it to the channel)", True)]))
+		self.addCommand("QUIT", Command(self.quit, help = [("QUIT", "Quit the chat server", None)]))
+
+		# Only servers of the federation may link to this one, each giving the secret shared by the network
+		if isinstance(self.network, Federation):
+			self.addCommand("PEER", Command(self.peer, 2, authorised = False, writes = True, usage = 5))
+
+		# Joins the other processes or servers, now there's a registry for their messages
+		if (self.network is not None):
+			self.network.open()
 
 
 	def onStop(self):
 		"""
 		Called when the server has terminated.
-		Cleans-up list of sockets.
+		Cleans-up the registry of connections.
 		"""
-		print("Server has stopped")
+		log(logging.INFO, "stopped")
 		self._sockets.clear()
+		self._names.clear()
+		self._channels.clear()
+		if (self.network is not None):
+			self.network.stop()
 
 
 	def onConnect(self, socket):
 		"""
 		Called when a socket connects to the server.
-		Adds socket to the list of sockets and broadcasts the connection.
+		Adds socket to the registry and broadcasts the connection.
 
 		socket: The socket to connect to the server.
 		"""
-		# Adds user to socket list and gets index
-		newUserRef = self.addSocket(socket, "user" + str(len(self._sockets)))
-		name = self._sockets[newUserRef][0]
+		# Names are given out by the hub when the port is shared with other processes, which is asked before
+		# the registry is locked, so other commands aren't held up waiting for it
+		name = None
+		if (self.network is not None):
+			name = self.network.connectUser()
+
+		self._socketsLock.acquireWrite()
+		try:
+			self.connect(socket, name)
+		finally:
+			self._socketsLock.releaseWrite()
 
-		# Outputs new connection to server
-		print(name + " is trying to connect")
-		print("Server has " + str(len(self._sockets)) + " active connections")
+	def connect(self, socket, name=None):
+		"""
+		Adds a new socket to the registry and sends it the connection info.
+		Must be called while holding the write lock.
+
+		socket: The socket which has connected.
+		name: The placeholder name given out by the hub, or None for one of this server's own. Is None by default.
+		"""
+		# The hub's name is given back if a user of this server has it, which only happens if the hub has lost track
+		if (name is not None) and not self.isNameFree(None, name):
+			self.network.removeUser(name)
+			name = None
+
+		# Adds user to the registry under a placeholder name
+		newUserRef = self.addSocket(socket, name or self.placeholderName())
+		name = newUserRef.name
+
+		# Logs new connection
+		log(logging.INFO, "connected", user = name, connections = len(self._sockets))
 
 		# Sends new user connection info, help info and the current user list
 		connectInfo = "Server has been found, please enter a suitable user name using the JOIN command"
@@ -44,28 +212,47 @@ class Server(Server):
 	def onDisconnect(self, socket):
 		"""
 		Called when a socket disconnects to the server.
-		Removes socket from the list of socket and broadcasts the disconnection.
+		Removes socket from the registry and broadcasts the disconnection.
 
 		socket: The socket to disconnect from the server.
 		"""
-		# Gets socket name and index
+		# A server linked to this one has gone
+		if hasattr(socket, "peer"):
+			self.network.unlink(socket)
+			return
+
+		self._socketsLock.acquireWrite()
+		try:
+			self.disconnect(socket)
+		finally:
+			self._socketsLock.releaseWrite()
+
+	def disconnect(self, socket):
+		"""
+		Removes a socket from the registry and broadcasts the disconnection.
+		Must be called while holding the write lock.
+
+		socket: The socket which has disconnected.
+		"""
+		# Gets socket connection and name
 		userRef = self.getSocket(socket)
-		name = self._sockets[userRef][0]
+		name = userRef.name
 
 		# Sends user disconnection info
 		disconnectInfo = "You've left the server"
 		self.sendToSocket(userRef, disconnectInfo)
 
-		# Alerts other users that a new user has connected
+		# Alerts the users sharing a channel with the user that they've disconnected
 		disconnectInfo = name + " has disconnected"
-		self.sendToAllOtherSockets(userRef, disconnectInfo)
+		self.sendToChannelMembers(userRef, disconnectInfo)
 
-		# Removes socket from socket list
+		# Removes socket from the registry, and from each of its channels
+		for channel in list(userRef.channels):
+			self.leaveChannel(userRef, channel)
 		self.removeSocket(userRef)
 
-		# Outputs disconnection to server
-		print(name + " has disconnected")
-		print("Server has " + str(len(self._sockets)) + " active connections")
+		# Logs disconnection
+		log(logging.INFO, "disconnected", user = name, connections = len(self._sockets))
 
 
 	def onMessage(self, socket, message):
@@ -77,66 +264,92 @@ class Server(Server):
 		message: The server message.
 		Returns: True if the connection hasn't been terminated, False if it has.
 		"""
-		# Parses server message for command and parameters and gets socket index
-		(command, sep, parameters) = message.strip().partition(" ")
-		userRef = self.getSocket(socket)
+		# Messages from servers linked to this one are handled by the federation
+		if hasattr(socket, "peer"):
+			return self.network.receive(socket, message)
+
+		# Parses server message for command and parameters, looking the command up by its verb
+		(verb, sep, parameters) = message.strip().partition(" ")
+		verb = verb.upper()
+		command = self._commands.get(verb)
+
+		# Only commands which change the registry exclude others, so every other command may run alongside others,
+		# while commands which wait on other processes take the lock themselves once they're done waiting
+		locking = (command is None) or command.locks
+		writing = locking and (command is not None) and command.writes
+		if writing:
+			self._socketsLock.acquireWrite()
+		elif locking:
+			self._socketsLock.acquireRead()
+
+		try:
+			# Gets socket connection
+			userRef = self.getSocket(socket)
+
+			if (userRef is not None):
+				return self.runCommand(userRef, verb, command, parameters)
+
+		finally:
+			if writing:
+				self._socketsLock.releaseWrite()
+			elif locking:
+				self._socketsLock.releaseRead()
+
+		return True
 
-		if (userRef != -1):
-			name = self._sockets[userRef][0]
-			authorised = self._sockets[userRef][2]
-
-			# Executes corresponding command
-			if (command.upper() == "HELP"):
-				print("HELP command - " + name)
-				self.help(userRef)
-
-			elif (command.upper() == "USERS"):
-				print("USERS command - " + name)
-				self.users(userRef)
-
-			elif (command.upper() == "JOIN"):
-				if not authorised:
-					print("JOIN command - " + name)
-					newName = parameters.replace(" ", "")
-					if (newName == ""):
-						self.error(userRef, 2)
-					else:
-						self.join(userRef, newName)
-				else:
-					self.error(userRef, 1)
-
-			elif (command.upper() == "RENAME"):
-				if authorised:
-					print("RENAME command - " + name)
-					newName = parameters.replace(" ", "")
-					if (newName == ""):
-						self.error(userRef, 3)
-					else:
-						self.rename(userRef, newName)
-				else:
-					self.error(userRef, 1)
-
-			elif (command.upper() == "MESSAGE"):
-				if authorised:
-					print("MESSAGE command - " + name)
-					(target, sep, content) = parameters.strip().partition(" ")
-					if ((target == "") or (content == "")):
-						self.error(userRef, 4)
-					else:
-						self.message(userRef, target, content)
-				else:
-					self.error(userRef, 1)
-
-			elif (command.upper() == "QUIT"):
-				print("QUIT command - " + name)
-				return self.quit(userRef)
+	def runCommand(self, userRef, verb, command, parameters):
+		"""
+		Checks that a user may run a command, and has entered its every argument, before running it.
+		Must be called while holding the lock the command needs.
 
-			else:
-				print("Invalid command")
-				self.error(userRef, 5)
+		userRef: The connection of the socket which has sent the command.
+		verb: The command's verb, in upper case.
+		command: The command, or None if the verb is unrecognised.
+		parameters: The parameters entered with the command.
+		Returns: True if the connection hasn't been terminated, False if it has.
+		"""
+		# Commands only for users who haven't joined are unrecognised once they have
+		if (command is None) or ((command.authorised is False) and userRef.authorised):
+			log(TRACE, "invalid", True, user = userRef.name)
+			self.error(userRef, 5)
+			return True
 
-		return True
+		if (command.authorised and not userRef.authorised):
+			self.error(userRef, 1)
+			return True
 
+		log(TRACE, "command", True, command = verb, user = userRef.name)
+		arguments = command.parse(parameters)
+		if (arguments is None):
+			self.error(userRef, command.usage)
+			return True
+
+		return command.handler(userRef, *arguments) is not False
+
+	def addCommand(self, verb, command):
+		"""
+		Adds a command users may enter, replacing any other with the same verb.
+
+		verb: The word the command is entered with, ignoring case.
+		command: The command.
+		"""
+		self._commands[verb.upper()] = command
+		self._helpFrames.clear()
+
+
+	def placeholderName(self):
+		"""
+		Gets a screen name for a new socket, until the user joins with one of their own.
+
+		Must be called while holding the write lock.
+
+		Returns: The first unused name of the form userN.
+		"""
+		while True:
+			name = "user" + str(self._nextUser)
+			self._nextUser += 1
+			if self.isNameFree(None, name):
+				return name
 
 	def addSocket(self, socket, name):
 		"""
@@ -144,93 +357,213 @@ class Server(Server):
 
 		socket: The socket which is being added to the server.
 		name: The screen name that the new socket will use.
-		Returns: The index of the new socket.
+		Returns: The connection of the new socket.
 		"""
-		self._sockets.append([name, socket, False])
-		print(self._sockets[len(self._sockets) - 1][0] + " added to server")
-		return len(self._sockets) - 1  # Returns new index
+		userRef = Connection(socket, name)
+		self._sockets[socket] = userRef
+		self._names[name.casefold()] = userRef
+		log(logging.DEBUG, "added", user = name)
+		return userRef
 
 	def renameSocket(self, userRef, newName, isJoin=False):
 		"""
 		Updates a socket's screen name.
+		Must be called without holding the lock, as the name is claimed from every other process or server
+		before the registry is locked to change it, so other commands aren't held up waiting for them.
 
-		userRef: The index of the socket to update the screen name of.
+		userRef: The connection of the socket to update the screen name of.
 		newName: The new screen name of the socket.
 		isJoin: True if user is joining the server, False otherwise. Is False by default.
 		Returns: True if socket successfully renamed, False otherwise.
 		"""
-		oldName = self._sockets[userRef][0]
+		key = newName.casefold()
+
+		# Holds the name while it's claimed, so no other user of this server can take it meanwhile
+		self._socketsLock.acquireWrite()
+		try:
+			oldName = userRef.name
+			isFree = self.isNameFree(userRef, newName)
+			if isFree:
+				self._claims[key] = userRef
+		finally:
+			self._socketsLock.releaseWrite()
+
+		if not isFree:
+			self.error(userRef, 6)
+			return False
+
+		# The name must also be free across every other process or server, once the user has joined
+		isClaimed = False
+		if ((self.network is not None) and (isJoin or userRef.authorised)):
+			isFree = self.network.renameUser(oldName, newName)
+			isClaimed = isFree
+
+		self._socketsLock.acquireWrite()
+		try:
+			del self._claims[key]
+
+			# The user may have gone, or been renamed by another server, while the name was claimed
+			isUpdated = (isFree and (self.getSocket(userRef.socket) is userRef) and (userRef.name == oldName))
+			if isUpdated:
+				del self._names[oldName.casefold()]
+				self._names[key] = userRef
+				userRef.name = newName
+				if isJoin:
+					userRef.authorised = True
+		finally:
+			self._socketsLock.releaseWrite()
 
-		if ((self.getSocketByName(newName) == -1) and (newName.lower() not in ["all", "everyone"])):
-			self._sockets[userRef][0] = newName
-			if isJoin:
-				self._sockets[userRef][2] = True
+		if isUpdated:
 			return True
 
+		# Gives back a name claimed for nothing
+		if isClaimed:
+			self.network.removeUser(newName)
 		self.error(userRef, 6)
 		return False
 
+	def isNameFree(self, userRef, name):
+		"""
+		Checks whether a user may take a screen name. A user may change the case of their own name, but no name may
+		look like a channel's. Must be called while holding the lock.
+
+		userRef: The connection of the user, or None for a new user.
+		name: The screen name.
+		Returns: True if no other user of this server has or is claiming the name, False otherwise.
+		"""
+		if (name.lower() in ["all", "everyone"]) or name.startswith("#"):
+			return False
+		return (self.getSocketByName(name) in [None, userRef]) and (self._claims.get(name.casefold(), userRef) is userRef)
+
 	def sendToSocket(self, userRef, message):
 		"""
 		Sends a message to a socket.
 
-		userRef: The index of the socket.
+		userRef: The connection of the socket.
 		message: The message to be sent.
 		"""
-		self._sockets[userRef][1].send(message.encode())
-		print("Message sent to " + str(self._sockets[userRef][0]))
+		userRef.socket.send(message.encode())
+		log(TRACE, "sent", True, to = userRef.name)
+
+	def sendFrameToSocket(self, userRef, encoded):
+		"""
+		Sends a message already encoded by frame() to a socket.
+
+		userRef: The connection of the socket.
+		encoded: The encoded message, which may be shared with other sockets.
+		"""
+		userRef.socket.sendFrame(encoded)
+		log(TRACE, "sent", True, to = userRef.name)
 
 	def sendToAllOtherSockets(self, userRef, message):
 		"""
 		Sends a message to all sockets except the current socket.
 
-		userRef: The index of the current socket.
+		userRef: The connection of the current socket, or None to send to every socket.
 		message: The message to be sent.
 		"""
-		for socRef in range(len(self._sockets)):
-			if (socRef != userRef):
-				self.sendToSocket(socRef, message)
+		# Encodes the message once, sharing the same bytes between every socket's queue
+		encoded = frame(message.encode())
+		for otherRef in self._sockets.values():
+			if (otherRef is not userRef):
+				otherRef.socket.sendFrame(encoded)
+
+		# And with the users of every other process or server
+		if (self.network is not None):
+			self.network.sendToAll(message)
+		log(TRACE, "sent", True, to = ("all" if (userRef is None) else "all other"))
+
+	def sendToChannel(self, channel, message):
+		"""
+		Sends a message to every member of a channel.
+
+		channel: The channel.
+		message: The message to be sent.
+		"""
+		encoded = frame(message.encode())
+		for memberRef in channel.members:
+			memberRef.socket.sendFrame(encoded)
+
+		# And to its members on every other process or server
+		if (self.network is not None):
+			self.network.sendToChannels([channel.name], message)
+		log(TRACE, "sent", True, to = channel.name)
+
+	def sendToChannelMembers(self, userRef, message):
+		"""
+		Sends a message to every other user sharing at least one channel with a user, once each.
+
+		userRef: The connection of the user.
+		message: The message to be sent.
+		"""
+		otherRefs = set()
+		for channel in userRef.channels:
+			otherRefs |= channel.members
+		otherRefs.discard(userRef)
+
+		encoded = frame(message.encode())
+		for otherRef in otherRefs:
+			otherRef.socket.sendFrame(encoded)
+
+		# And to the members of those channels on every other process or server
+		if ((self.network is not None) and len(userRef.channels)):
+			self.network.sendToChannels([channel.name for channel in userRef.channels], message)
+		log(TRACE, "sent", True, to = "channels of " + userRef.name)
 
 	def getSocket(self, socket):
 		"""
-		Gets the index for a socket currently connected to the server.
+		Gets the connection of a socket currently connected to the server.
 
 		socket: The socket reference.
-		Returns: The index of the socket.
+		Returns: The connection of the socket, or None if it isn't connected.
 		"""
-		for socRef in range(len(self._sockets)):
-			if (self._sockets[socRef][1] == socket):
-				print(self._sockets[socRef][0] + " found")
-				return socRef
-		print(str(socket) + " not found")
-		return -1
+		return self._sockets.get(socket)
 
 	def getSocketByName(self, name):
 		"""
-		Gets the index for a socket currently connected to the server.
+		Gets the connection of a socket currently connected to the server, ignoring case.
 
 		name: Screen name of the socket.
-		Returns: The index of the socket.
+		Returns: The connection of the socket, or None if no socket has the name.
+		"""
+		return self._names.get(name.casefold())
+
+	def getChannel(self, channelName):
 		"""
-		for socRef in range(len(self._sockets)):
-			if (self._sockets[socRef][0] == name):
-				print(name + " found")
-				return socRef
-		print(name + " not found")
-		return -1
+		Gets a channel, ignoring case.
+
+		channelName: The name of the channel, starting with #.
+		Returns: The channel, or None if there's no channel with the name.
+		"""
+		return self._channels.get(channelName.casefold())
+
+	def leaveChannel(self, userRef, channel):
+		"""
+		Removes a user from a channel, removing the channel once it's empty.
+
+		userRef: The connection of the user.
+		channel: The channel.
+		"""
+		channel.members.discard(userRef)
+		userRef.channels.discard(channel)
+		if (len(channel.members) == 0):
+			del self._channels[channel.name.casefold()]
 
 	def removeSocket(self, userRef):
 		"""
 		Removes a socket from the server.
 
-		userRef: The index of the socket being removed.
+		userRef: The connection of the socket being removed.
 		Returns: True if socket successfully removed, False if socket couldn't be removed.
 		"""
-		if ((userRef >= 0) or (userRef < len(self._sockets))):
-			print(self._sockets[userRef][0] + " removed from server")
-			del self._sockets[userRef]
+		if (self._sockets.get(userRef.socket) is userRef):
+			del self._sockets[userRef.socket]
+			del self._names[userRef.name.casefold()]
+			if (self.network is not None):
+				self.network.removeUser(userRef.name)
+			log(logging.DEBUG, "removed", user = userRef.name)
 			return True
-		print(self._sockets[userRef][0] + " couldn't be removed from server")
+		log(logging.WARNING, "unremovable", user = userRef.name)
 		return False
 
 
@@ -238,109 +571,270 @@ class Server(Server):
 		"""
 		Sends a list of available commands to a user.
 
-		userRef: The index of the socket to send the information to.
+		userRef: The connection of the socket to send the information to.
 		"""
-		helpInfo = "\nAvailable Commands:"
-		if (self._sockets[userRef][2] == True):
-			helpInfo += "\n    HELP                                  - Get list of available commands"
-			helpInfo += "\n    USERS                                 - Get a list of all users currently online"
-			helpInfo += "\n    RENAME <new name>                     - Change your screen name"
-			helpInfo += "\n    MESSAGE <recipient> <message content> - Send a message to the recipient (use ALL to send a message to everyone)"
-			helpInfo += "\n    QUIT                                  - Quit the chat server"
-		else:
-			helpInfo += "\n    HELP            - Get list of available commands"
-			helpInfo += "\n    USERS           - Get a list of all users currently online"
-			helpInfo += "\n    JOIN <new name> - Join the chat server with a unique screen name"
-			helpInfo += "\n    QUIT            - Quit the chat server"
-		self.sendToSocket(userRef, helpInfo)
+		# The list only changes when a command is added, so is encoded once for each kind of user
+		encoded = self._helpFrames.get(userRef.authorised)
+		if (encoded is None):
+			lines = [line for command in self._commands.values() for line in command.help if (line[2] in [None, userRef.authorised])]
+			width = max(len(line[0]) for line in lines) + 1
+			helpInfo = "Available Commands:" + "".join("\n    " + syntax.ljust(width) + "- " + description for (syntax, description, authorised) in lines)
+			encoded = frame(helpInfo.encode())
+			self._helpFrames[userRef.authorised] = encoded
+		self.sendFrameToSocket(userRef, encoded)
 
 	def users(self, userRef):
 		"""
 		Sends a list of the current online user names.
 
-		userRef: The index of the socket to send the information to.
+		userRef: The connection of the socket to send the information to.
 		"""
-		num = len(self._sockets)
-		if (num == 0):
-			usersInfo = "\nThere are no other active users"
+		# Lists the users of every other process or server too
+		names = [otherRef.name for otherRef in self._sockets.values()]
+		if (self.network is not None):
+			names += self.network.users()
+
+		if (len(names) == 0):
+			usersInfo = "There are no other active users"
 		else:
-			usersInfo = "\nCurrent Active Users:"
-			for i in range(num):
-				usersInfo += "\n    " + self._sockets[i][0]
-				if (i == userRef):
-					usersInfo += " (You)"
+			usersInfo = "Current Active Users:" + "".join("\n    " + name + (" (You)" if (name == userRef.name) else "") for name in names)
 		self.sendToSocket(userRef, usersInfo)
 
 	def join(self, userRef, newName):
 		"""
-		Updates a socket's screen name.
+		Joins the server under a screen name, or a channel once the user has joined the server.
 
-		userRef: The index of the socket to update the screen name of.
-		newName: The new screen name of the socket.
-		Returns: True if socket successfully renamed, False otherwise.
+		userRef: The connection of the socket to update the screen name of.
+		newName: The new screen name of the socket, or the name of the channel, starting with #.
 		"""
-		isUpdated = self.renameSocket(userRef, newName, True)
+		if userRef.authorised:
+			if not newName.startswith("#"):
+				self.error(userRef, 1)
+			elif (newName == "#"):
+				self.error(userRef, 10)
+			else:
+				self._socketsLock.acquireWrite()
+				try:
+					self.joinChannel(userRef, newName)
+				finally:
+					self._socketsLock.releaseWrite()
+			return
 
-		if isUpdated:
+		if not self.renameSocket(userRef, newName, True):
+			return
+
+		self._socketsLock.acquireRead()
+		try:
 			self.sendToSocket(userRef, "You've successfully joined the server as " + newName)
 			self.help(userRef)
 			self.users(userRef)
 
-			self.sendToAllOtherSockets(userRef, newName + " has joined")
+			self.sendToChannelMembers(userRef, newName + " has joined")
+		finally:
+			self._socketsLock.releaseRead()
 
 	def rename(self, userRef, newName):
 		"""
 		Updates a socket's screen name.
 
-		userRef: The index of the socket to update the screen name of.
+		userRef: The connection of the socket to update the screen name of.
 		newName: The new screen name of the socket.
 		"""
-		oldName = self._sockets[userRef][0]
+		oldName = userRef.name
 
-		isUpdated = self.renameSocket(userRef, newName)
+		if not self.renameSocket(userRef, newName):
+			return
 
-		if isUpdated:
+		self._socketsLock.acquireRead()
+		try:
 			self.sendToSocket(userRef, "Your screen name has been changed to " + newName)
-			self.sendToAllOtherSockets(userRef, oldName + " has changed their name to " + newName)
+			self.sendToChannelMembers(userRef, oldName + " has changed their name to " + newName)
+		finally:
+			self._socketsLock.releaseRead()
 		
 	def message(self, userRef, target, content):
 		"""
 		Sends a message to a user or a group of users.
 		
-		userRef: The index of the socket which is sending the message.
+		userRef: The connection of the socket which is sending the message.
 		target: The target socket or sockets of the message.
 		content: The content of the message.
 		"""
-		name = self._sockets[userRef][0]
+		name = userRef.name
+		log(TRACE, "message", True, sender = name, target = target)
 		
 		# Sends message to all users
 		if (target.lower() in ["all", "everyone"]):
-			print("Sending to everyone")
-
 			message = name + ": " + content
-			self.sendToAllOtherSockets(userRef, message)
-			self.sendToSocket(userRef, message)
+			self.sendToAllOtherSockets(None, message)
+
+		# Sends message to every member of a channel the user is in
+		elif target.startswith("#"):
+			channel = self.getChannel(target)
+			if (channel is None) or (userRef not in channel.members):
+				self.error(userRef, 8)
+				return
+
+			message = name + " (" + channel.name + "): " + content
+			self.sendToChannel(channel, message)
 
 		# Sends message to target user
 		else:
-			print("Sending to " + target)
 			message = name + " (Private): " + content
 
+			# The target may be connected to another process or server
 			targetSocket = self.getSocketByName(target)
-			if (targetSocket == -1):
+			if (targetSocket is not None):
+				self.sendToSocket(targetSocket, message)
+			elif ((self.network is None) or not self.network.sendTo(target, message)):
 				self.error(userRef, 7)
 				return
 
-			self.sendToSocket(targetSocket, message)
-
 			message = name + " (" + target + "): " + content
 			self.sendToSocket(userRef, message)
 		
+	def joinChannel(self, userRef, channelName):
+		"""
+		Adds a user to a channel, starting the channel if nobody is in it.
+
+		userRef: The connection of the user joining.
+		channelName: The name of the channel, starting with #.
+		"""
+		channel = self.getChannel(channelName)
+		if (channel is None):
+			channel = Channel(channelName)
+			self._channels[channelName.casefold()] = channel
+		elif (userRef in channel.members):
+			self.sendToSocket(userRef, "You're already in " + channel.name)
+			return
+
+		self.sendToChannel(channel, userRef.name + " has joined " + channel.name)
+		channel.members.add(userRef)
+		userRef.channels.add(channel)
+		self.sendToSocket(userRef, "You've joined " + channel.name)
+
+	def part(self, userRef, channelName):
+		"""
+		Removes a user from a channel.
+
+		userRef: The connection of the user leaving.
+		channelName: The name of the channel, starting with #.
+		"""
+		if (not channelName.startswith("#")) or (channelName == "#"):
+			self.error(userRef, 9)
+			return
+
+		channel = self.getChannel(channelName)
+		if (channel is None) or (userRef not in channel.members):
+			self.error(userRef, 8)
+			return
+
+		self.leaveChannel(userRef, channel)
+		self.sendToSocket(userRef, "You've left " + channel.name)
+		self.sendToChannel(channel, userRef.name + " has left " + channel.name)
+
+	def deliver(self, name, message):
+		"""
+		Sends a message from another process or server to one of this server's users.
+
+		name: The screen name of the user.
+		message: The message to be sent.
+		Returns: True if the user was found, False otherwise.
+		"""
+		self._socketsLock.acquireRead()
+		try:
+			userRef = self.getSocketByName(name)
+			if (userRef is None):
+				return False
+			self.sendToSocket(userRef, message)
+			return True
+		finally:
+			self._socketsLock.releaseRead()
+
+	def deliverToAll(self, message):
+		"""
+		Sends a message from another process or server to every one of this server's users.
+
+		message: The message to be sent.
+		"""
+		self._socketsLock.acquireRead()
+		try:
+			encoded = frame(message.encode())
+			for userRef in self._sockets.values():
+				userRef.socket.sendFrame(encoded)
+		finally:
+			self._socketsLock.releaseRead()
+
+	def deliverToChannels(self, channelNames, message):
+		"""
+		Sends a message from another process or server to every one of this server's users in any of the channels, once each.
+
+		channelNames: The names of the channels.
+		message: The message to be sent.
+		"""
+		self._socketsLock.acquireRead()
+		try:
+			memberRefs = set()
+			for channelName in channelNames:
+				channel = self.getChannel(channelName)
+				if (channel is not None):
+					memberRefs |= channel.members
+
+			encoded = frame(message.encode())
+			for memberRef in memberRefs:
+				memberRef.socket.sendFrame(encoded)
+		finally:
+			self._socketsLock.releaseRead()
+
+	def release(self, name):
+		"""
+		Gives a user of this server a placeholder name, as a user of another server claimed their name first.
+
+		name: The screen name claimed.
+		"""
+		self._socketsLock.acquireWrite()
+		try:
+			userRef = self.getSocketByName(name)
+			if (userRef is None):
+				return
+			oldName = userRef.name
+			newName = self.placeholderName()
+		finally:
+			self._socketsLock.releaseWrite()
+
+		if not self.renameSocket(userRef, newName):
+			return
+
+		self._socketsLock.acquireRead()
+		try:
+			self.sendToSocket(userRef, "Your screen name has been changed to " + newName + ", as " + oldName + " was taken on another server")
+			if userRef.authorised:
+				self.sendToChannelMembers(userRef, oldName + " has changed their name to " + newName)
+		finally:
+			self._socketsLock.releaseRead()
+
+	def peer(self, userRef, node, secret):
+		"""
+		Turns a connection into a link with another server of the federation, if it gave the network's secret.
+
+		userRef: The connection of the server's socket.
+		node: The address the server is reached on.
+		secret: The secret given.
+		"""
+		# A connection without the secret is treated as if there was no such command
+		if not self.network.admits(secret):
+			log(logging.WARNING, "refused", user = userRef.name, node = node)
+			self.error(userRef, 5)
+			return
+
+		self.removeSocket(userRef)
+		self.network.link(userRef.socket, node)
+
 	def quit(self, userRef):
 		"""
 		Initiates a connection termination.
 
-		userRef: The index of the socket which is disconnecting.
+		userRef: The connection of the socket which is disconnecting.
 		Returns: False to initiate disconnection.
 		"""
 		quitInfo = "You have successfully left the chat server."
@@ -351,28 +845,12 @@ class Server(Server):
 		"""
 		Sends a usage error message to the user.
 
-		userRef: The index of the socket to send the message to.
+		userRef: The connection of the socket to send the message to.
 		code: The error code.
 		"""
-		errorInfo = "\n"
-		if (code == 1):
-			errorInfo += "You do not have access to that command. For a list of available commands, enter HELP."
-		elif (code == 2):
-			errorInfo += "Incorrect usage of JOIN command. Use following format:\n    JOIN <new name>"
-		elif (code == 3):
-			errorInfo += "Incorrect usage of RENAME command. Use following format:\n    RENAME <new name>"
-		elif (code == 4):
-			errorInfo += "Incorrect usage of MESSAGE command. Use following format:\n    MESSAGE <recipient> <message content>"
-		elif (code == 5):
-			errorInfo += "Unrecognised command entered - check your spelling. For a list of available commands, enter HELP."
-		elif (code == 6):
-			errorInfo += "New name entered is unavailable - try a different name. For a list of active users, enter USERS."
-		elif (code == 7):
-			errorInfo += "Unrecognised name entered - check your spelling. For a list of active users, enter USERS."
-		else:
-			return
-
-		self.sendToSocket(userRef, errorInfo)
+		encoded = ERROR_FRAMES.get(code)
+		if (encoded is not None):
+			self.sendFrameToSocket(userRef, encoded)
 
 
 
@@ -383,25 +861,73 @@ def error(code):
 	code: The error code.
 	"""
 	if (code == 1):
-		print("Incorrect usage of server. Use following format:\n    $ python3 " + str(sys.argv[0]) + " <ip address> <port>")
+		print("Incorrect usage of server. Use following format:\n    $ python3 " + str(sys.argv[0]) + " <ip address> <port> <threads or selectors (optional)> <workers (optional)> <processes (optional)> <servers to link to (optional)>...\nSet PEER_SECRET=<secret> to link with other servers given the same secret, as servers can't be linked without one.\nSet LOG_LEVEL=TRACE to log every message, and LOG_SAMPLE=<n> to log only one in every n of each kind.")
 	elif (code == 2):
 		print("IP address or port couldn't be found.")
 	sys.exit()
 
 
 # Ensures that IP address and port are passed in
-if (len(sys.argv) != 3):
+if (len(sys.argv) < 3):
 	error(1)
 
-# Parse the IP address and port you wish to listen on.
+# Parse the IP address and port you wish to listen on, how connections should be handled, how many workers
+# handle commands (0 for none), how many processes share the port, and the servers to link to as <ip>:<port>
 ip = sys.argv[1]
 port = int(sys.argv[2])
+backend = sys.argv[3] if (len(sys.argv) >= 4) else "threads"
+if (backend not in ["threads", "selectors"]):
+	error(1)
+if not all(argument.isdigit() for argument in sys.argv[4:6]):
+	error(1)
+workers = int(sys.argv[4]) if (len(sys.argv) >= 5) else 0
+processes = int(sys.argv[5]) if (len(sys.argv) >= 6) else 1
+peers = []
+for peer in sys.argv[6:]:
+	(peerIp, sep, peerPort) = peer.rpartition(":")
+	if (not peerIp) or (not peerPort.isdigit()):
+		error(1)
+	peers.append((peerIp, int(peerPort)))
+
+# Servers only link with others given the same secret, while a server sharing its port with other processes
+# can't also be linked to other servers
+secret = os.environ.get("PEER_SECRET", "")
+if (len(peers) and not secret) or ((processes > 1) and secret):
+	error(1)
 
-# Create the server
-server = Server()
+# Logging is set through the environment, with every message only logged at TRACE, and sampled
+logLevel = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+logSample = os.environ.get("LOG_SAMPLE", "100")
+if (not isinstance(logLevel, int)) or (not logSample.isdigit()):
+	error(1)
+logSample = int(logSample)
 
-# Start server
-try:
-	server.start(ip, port)
-except:
-	error(2)
+def run(busSocket=None):
+	"""
+	Creates and starts the server.
+
+	busSocket: The process's connection to the hub if other processes share the port, None otherwise.
+	"""
+	server = Server()
+	server.workers = workers or None
+	if (busSocket is not None):
+		server.reusePort = True
+		server.network = Bus(server, busSocket)
+	elif secret:
+		# Other servers given the secret may link to this one, as well as those it links to
+		server.network = Federation(server, ip + ":" + str(port), peers, secret)
+
+	# Start server, writing its log on a thread of its own
+	mylog.start(logLevel, logSample)
+	try:
+		server.start(ip, port, backend)
+	except:
+		error(2)
+	finally:
+		mylog.stop()
+
+# Each process has a core of its own, with the kernel sharing connections between them
+if (processes > 1):
+	launch(processes, run)
+else:
+	run()
@@ -5,8 +5,13 @@ Network server skeleton.
 This shows how you can create a server that listens on a given network socket, dealing
 with incoming messages as and when they arrive. To start the server simply call its
 start() method passing the IP address on which to listen (most likely 127.0.0.1) and 
-the TCP port number (greater than 1024). The Server class should be subclassed here, 
-implementing some or all of the following five events. 
+the TCP port number (greater than 1024). By default each connection is handled on a thread
+of its own; pass backend="selectors" to start() to handle every connection on a single thread
+instead, which scales to many thousands of connections. Setting the workers attribute calls
+onMessage on a pool of that many threads, while the backend's own threads carry on reading and
+writing, and each connection's messages are still handled in the order they arrived. AsyncServer is the asyncio counterpart,
+started with "await server.start(ip, port)", whose events may also be coroutines. The Server
+class should be subclassed here, implementing some or all of the following five events. 
 
 	onStart(self)
 		This is called when the server starts - i.e. shortly after the start() method is
@@ -0,0 +1,77 @@
+"""
+
+test_ex2utils.py- Regression tests for ex2utils, run with "python3 -m unittest" from this directory.
+"""
+
+
+import socket as socketlib
+import threading
+import unittest
+from ex2utils import Server
+
+
+class EchoServer(Server):
+
+	def onMessage(self, socket, message):
+		socket.send(message.encode())
+		return True
+
+
+def freePort():
+	"""Returns: A port nothing is listening on."""
+	with socketlib.socket() as probe:
+		probe.bind(("127.0.0.1", 0))
+		return probe.getsockname()[1]
+
+
+class SelectorsWorkersTest(unittest.TestCase):
+	"""
+	Replies sent from workers are handed to the selectors event loop, which must never lose one, however the
+	workers' calls interleave with the loop's.
+	"""
+
+	CLIENTS = 20
+	ROUNDS = 200
+
+	def setUp(self):
+		self.server = EchoServer()
+		self.server.workers = 4
+		self.port = freePort()
+		self.thread = threading.Thread(target = self.server.start, args = ("127.0.0.1", self.port, "selectors"), daemon = True)
+		self.thread.start()
+		for attempt in range(50):
+			try:
+				socketlib.create_connection(("127.0.0.1", self.port)).close()
+				break
+			except OSError:
+				threading.Event().wait(0.1)
+
+	def tearDown(self):
+		self.server.stop()
+		self.thread.join(5)
+
+	def ping(self, results, index):
+		with socketlib.create_connection(("127.0.0.1", self.port), timeout = 5) as client:
+			reader = client.makefile("rb")
+			try:
+				for turn in range(self.ROUNDS):
+					line = ("ping %d %d" % (index, turn)).encode()
+					client.sendall(line + b"\n")
+					if reader.readline().strip() != line:
+						return
+			except OSError:
+				return
+			results[index] = True
+
+	def test_concurrentClientsAllAnswered(self):
+		results = [False] * self.CLIENTS
+		threads = [threading.Thread(target = self.ping, args = (results, index)) for index in range(self.CLIENTS)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(results, [True] * self.CLIENTS)
+
+
+if __name__ == "__main__":
+	unittest.main()